@@ -20,11 +20,370 @@
 ### In addition to python packages listed below, the script requires GNparser
 ### https://github.com/GlobalNamesArchitecture/gnparser
 
-import argparse, requests, sys, subprocess, json, time, warnings, pandas, os
+import argparse, requests, sys, subprocess, json, time, warnings, pandas, os, sqlite3, threading, atexit, zlib, heapq
+import array, bisect, collections, csv, itertools, random, email.utils, functools, math
 from fuzzywuzzy import fuzz #see note on function fuzzy_score
-from requests.exceptions import ConnectionError, SSLError
-from numpy import nan #needed at the end to parse temporary file
-#argparse below inside if __name__ == '__main__'
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, SSLError, Timeout
+from numpy import nan #used for missing ids
+from concurrent.futures import ThreadPoolExecutor, Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+#argparse below inside main()
+
+#############################################
+#Runtime metrics: latency histograms for each stage, counters (remote requests, retries, cache hits and misses, records)
+#and throughput. Written as json at the end of the run (--metrics) and periodically as a Prometheus textfile (--metrics-prometheus)
+class Metrics:
+    #upper bounds of the latency histogram buckets, in seconds
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, math.inf)
+    #names of counter labels in the Prometheus textfile
+    label_names = {'requests':'service', 'errors':'service', 'retries':'service',
+                   'cache_hits':'function', 'cache_misses':'function', 'memory_hits':'function',
+                   'shared_lookups':'function', 'records':'status'}
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = {}
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.export_lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            try:
+                stats = self.stages[stage]
+            except KeyError:
+                stats = self.stages[stage] = {'count':0, 'sum':0.0, 'max':0.0, 'buckets':[0] * len(self.buckets)}
+            stats['count'] += 1
+            stats['sum'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    #counters have a name and optionally a label, for example count('cache_hits', 'otl_tnrs')
+    def count(self, name, label = None, n = 1):
+        with self.lock:
+            self.counters[(name, label)] += n
+
+    #returns all metrics in a dictionary that can be saved as json
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            counters = {}
+            for (name, label), n in sorted(self.counters.items(), key = lambda x: (x[0][0], str(x[0][1]))):
+                if label is None:
+                    counters[name] = n
+                else:
+                    counters.setdefault(name, {})[label] = n
+            stages = {}
+            for stage, stats in self.stages.items():
+                cumulative = list(itertools.accumulate(stats['buckets']))
+                stages[stage] = {'count':stats['count'],
+                                 'total_seconds':stats['sum'],
+                                 'mean_seconds':stats['sum'] / stats['count'],
+                                 'max_seconds':stats['max'],
+                                 'histogram':{str(le):n for le, n in zip(self.buckets, cumulative)}}
+        records = sum(n for (name, label), n in self.counters.items() if name == 'records')
+        return {'elapsed_seconds':elapsed,
+                'records':records,
+                'records_per_second':records / elapsed if elapsed else 0,
+                'stages':stages,
+                'counters':counters}
+
+    def write_json(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.summary(), outfile, indent = 2)
+
+    #the file is replaced at once, so it is never read incomplete
+    def write_prometheus(self, path):
+        summary = self.summary()
+        lines = ['# TYPE taxreformer_elapsed_seconds gauge',
+                 'taxreformer_elapsed_seconds ' + str(summary['elapsed_seconds']),
+                 '# TYPE taxreformer_records_per_second gauge',
+                 'taxreformer_records_per_second ' + str(summary['records_per_second']),
+                 '# TYPE taxreformer_stage_seconds histogram']
+        for stage, stats in summary['stages'].items():
+            for le, n in stats['histogram'].items():
+                le = '+Inf' if le == 'inf' else le
+                lines.append('taxreformer_stage_seconds_bucket{stage="' + stage + '",le="' + le + '"} ' + str(n))
+            lines.append('taxreformer_stage_seconds_sum{stage="' + stage + '"} ' + str(stats['total_seconds']))
+            lines.append('taxreformer_stage_seconds_count{stage="' + stage + '"} ' + str(stats['count']))
+        for name, value in summary['counters'].items():
+            lines.append('# TYPE taxreformer_' + name + '_total counter')
+            if isinstance(value, dict):
+                for label, n in value.items():
+                    lines.append('taxreformer_' + name + '_total{' + self.label_names.get(name, 'label') + '="' + str(label) + '"} ' + str(n))
+            else:
+                lines.append('taxreformer_' + name + '_total ' + str(value))
+        with self.export_lock:
+            with open(path + '.tmp', 'w') as outfile:
+                outfile.write('\n'.join(lines) + '\n')
+            os.replace(path + '.tmp', path)
+
+    #writes the Prometheus textfile every interval seconds in a background thread
+    def export_prometheus(self, path, interval = 15):
+        def export():
+            while True:
+                self.write_prometheus(path)
+                time.sleep(interval)
+        threading.Thread(target = export, daemon = True).start()
+
+metrics = Metrics()
+
+#############################################
+#Tracing (--trace): spans for each stage and remote request, grouped by record, saved in the Chrome trace event format
+#that can be opened in chrome://tracing, https://ui.perfetto.dev or https://www.speedscope.app
+#Each record searched gets a span with its name and the path taken through the fallbacks of search_name(),
+#built from the branches marked with trace_branch(). Spans of stages and requests are tagged with the name and branch
+#of the record being searched in the same thread. A summary lists the slowest records and the most expensive paths
+class Tracer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.records = [] #(seconds, name, path, problem) for each record searched
+        self.threads = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    #adds a complete event (ph X), with start and end from time.perf_counter()
+    def span(self, name, category, start, end, **args):
+        record = getattr(self.local, 'name', None)
+        if record is not None:
+            args['name'] = str(record)
+            args['branch'] = ' > '.join(self.local.path)
+        self.add({'name':name, 'cat':category, 'ph':'X',
+                  'ts':(start - self.start) * 1e6, 'dur':(end - start) * 1e6, 
+                  'args':args})
+
+    def add(self, event):
+        thread = threading.current_thread()
+        event['pid'] = self.pid
+        event['tid'] = thread.ident
+        with self.lock:
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self.events.append({'name':'thread_name', 'ph':'M', 'pid':self.pid, 'tid':thread.ident, 
+                                    'args':{'name':thread.name}})
+            self.events.append(event)
+
+    def begin_record(self, name):
+        self.local.name = name
+        self.local.path = []
+
+    def end_record(self, start, end, problem):
+        path = ' > '.join(self.local.path) or 'no branch'
+        self.span('record', 'record', start, end, path = path, problem = problem)
+        with self.lock:
+            self.records.append((end - start, str(self.local.name), path, problem))
+        self.local.name = None
+
+    #marks a branch taken while searching the current record, also shown as an instant event
+    def branch(self, branch):
+        if getattr(self.local, 'name', None) is None:
+            return
+        self.local.path.append(branch)
+        self.add({'name':branch, 'cat':'branch', 'ph':'i', 's':'t',
+                  'ts':(time.perf_counter() - self.start) * 1e6,
+                  'args':{'name':str(self.local.name)}})
+
+    #returns the n slowest records and the n paths with the largest total time
+    def summary(self, n = 10):
+        with self.lock:
+            records = list(self.records)
+        slowest = sorted(records, key = lambda x: x[0], reverse = True)[:n]
+        paths = {}
+        for seconds, name, path, problem in records:
+            stats = paths.setdefault(path, {'path':path, 'records':0, 'total_seconds':0.0, 'max_seconds':0.0})
+            stats['records'] += 1
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        for stats in paths.values():
+            stats['mean_seconds'] = stats['total_seconds'] / stats['records']
+        return {'slowest_records':[{'name':name, 'seconds':seconds, 'path':path, 'problem':problem} 
+                                   for seconds, name, path, problem in slowest],
+                'paths':sorted(paths.values(), key = lambda x: x['total_seconds'], reverse = True)[:n]}
+
+    def write(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as outfile:
+            json.dump({'traceEvents':events, 'displayTimeUnit':'ms', 'otherData':self.summary()}, outfile)
+
+    #summary as text, to be shown at the end of a run
+    def format_summary(self, n = 10):
+        summary = self.summary(n)
+        lines = ['Slowest records:']
+        for record in summary['slowest_records']:
+            lines.append('  {:9.3f} s  {}  [{}]'.format(record['seconds'], record['name'], record['path']))
+        lines.append('Most expensive paths (records, total, mean and max seconds):')
+        for stats in summary['paths']:
+            lines.append('  {:7d} {:10.3f} {:9.3f} {:9.3f}  {}'.format(stats['records'], stats['total_seconds'], 
+                                                                       stats['mean_seconds'], stats['max_seconds'], stats['path']))
+        return '\n'.join(lines) + '\n'
+
+#tracer used by the functions below. It is None unless started with start_trace()
+tracer = None
+
+def start_trace():
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+#marks a branch taken while searching a record, if tracing
+def trace_branch(branch):
+    if tracer is not None:
+        tracer.branch(branch)
+
+#decorator for functions searching a single record (the first argument), so that spans in the same thread are grouped by record
+#the function returns the problem found for the record (see resolve_record)
+def traced_record(function):
+    @functools.wraps(function)
+    def wrapper(record, *args, **kwargs):
+        if tracer is None:
+            return function(record, *args, **kwargs)
+        tracer.begin_record(record['name'])
+        start = time.perf_counter()
+        problem = 'error'
+        try:
+            problem = function(record, *args, **kwargs)
+            return problem
+        finally:
+            tracer.end_record(start, time.perf_counter(), problem)
+    return wrapper
+
+#decorator recording the latency of each call to a function as a stage in metrics, and as a span if tracing
+def timed(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                metrics.observe(stage, end - start)
+                if tracer is not None:
+                    tracer.span(stage, 'stage', start, end)
+        return wrapper
+    return decorator
+
+#Lets concurrent calls with the same key share a single execution, for example threads searching the same name
+#The first caller runs the function, and the others wait for its result (or exception) instead of repeating the work
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            metrics.count('shared_lookups', self.name)
+            start = time.perf_counter()
+            try:
+                return call.result()
+            finally:
+                if tracer is not None:
+                    tracer.span('shared ' + self.name, 'wait', start, time.perf_counter())
+        
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as err:
+            call.set_exception(err)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+#Results of a function kept in memory, up to max_size keys
+#When full, the oldest result is removed to make room for a new one
+class BoundedMemo:
+    def __init__(self, max_size = 100000):
+        self.results = {}
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    #raises KeyError if the key is not kept, as a dictionary
+    def __getitem__(self, key):
+        return self.results[key]
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key not in self.results and len(self.results) >= self.max_size:
+                del self.results[next(iter(self.results))] #remove oldest result
+            self.results[key] = value
+
+#GNparser is kept running in streaming mode, receiving one name per line in stdin and
+#writing one line of json per name in stdout. This avoids starting a new process for each name
+#If the worker cannot be used (for example, GNparser version without streaming), we fall back to one process per name
+class GNparserWorker:
+    def __init__(self, gnpath):
+        self.gnpath = gnpath
+        self.process = None
+        self.streaming = True
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process = subprocess.Popen([self.gnpath, '--details', '--format', 'compact', '--stream'],
+                                        stdin = subprocess.PIPE,
+                                        stdout = subprocess.PIPE,
+                                        stderr = subprocess.DEVNULL,
+                                        universal_newlines = True,
+                                        bufsize = 1)
+
+    #returns the json string produced by GNparser for a name
+    def parse(self, name):
+        with self.lock:
+            if self.streaming:
+                try:
+                    if self.process is None or self.process.poll() is not None:
+                        self.start()
+                    self.process.stdin.write(name.replace('\n', ' ') + '\n')
+                    self.process.stdin.flush()
+                    result_string = self.process.stdout.readline()
+                except OSError:
+                    result_string = ''
+                if result_string:
+                    return result_string
+                warnings.warn('GNparser could not be used in streaming mode, starting one process per name.')
+                self.streaming = False
+                self.close()
+        return subprocess.check_output([self.gnpath,'--details', '--format','compact', name], stderr=subprocess.STDOUT) #call GNparser
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout = 10)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+            self.process = None
+
+#one worker for each path to GNparser
+GNparser_workers = {}
+GNparser_lock = threading.Lock()
+#parsed names are kept in memory
+GNparser_results = BoundedMemo()
+
+def close_GNparser_workers():
+    for worker in GNparser_workers.values():
+        worker.close()
+    GNparser_workers.clear()
+
+atexit.register(close_GNparser_workers)
 
 # Function to call GNparser for a scientific name
 # Takes as input the name as a string and the path to GNparser
@@ -34,9 +393,20 @@ from numpy import nan #needed at the end to parse temporary file
 # cs: corrected species name
 # csub: corrected subspecific names
 
+@timed('GNparser')
 def GNparser(name, gnpath):
+    try:
+        out_dict = dict(GNparser_results[(name, gnpath)])
+        metrics.count('memory_hits', 'GNparser')
+        return out_dict
+    except KeyError:
+        pass
+    
     out_dict = {}
-    result_string = subprocess.check_output([gnpath,'--details', '--format','compact', name], stderr=subprocess.STDOUT) #call GNparser
+    with GNparser_lock:
+        if gnpath not in GNparser_workers:
+            GNparser_workers[gnpath] = GNparserWorker(gnpath)
+    result_string = GNparser_workers[gnpath].parse(name)
     result_dict = json.loads(result_string)
 
     for word in result_dict['words']:
@@ -49,88 +419,797 @@ def GNparser(name, gnpath):
         elif word['wordType'] == 'INFRASPECIES':
             out_dict['csub'] = word['normalized']
 
-    return out_dict
+    GNparser_results[(name, gnpath)] = out_dict
+    return dict(out_dict)
 
-#this function is a wrapper for taxonomic resolution services in otl api v3.
-#if service returns an error code, it pauses execution and tries again  in wait_time seconds
-#(useful if making a number of requests that can pass the api daily limit)
-def otl_tnrs(query, do_approximate = True, wait_time = 600, context = 'Arthropods'):
-    contact_otl = True
-    while contact_otl:
+#############################################
+#Persistent cache of results from remote services, stored in a SQLite database
+#Keys include the function, the query, the OTT context and the taxonomic filter
+#Each entry records the version of Open Tree Taxonomy used, and entries for other versions are deleted when the cache is opened
+#Entries older than ttl seconds are ignored, and the oldest entries are evicted when there are more than max_entries
+class ResolutionCache:
+    def __init__(self, cache_dir, ott_version, ttl = 30 * 86400, max_entries = 1000000):
+        os.makedirs(cache_dir, exist_ok = True)
+        self.path = os.path.join(cache_dir, 'TaxReformer_cache.sqlite')
+        self.ott_version = ott_version
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, ott_version TEXT, created REAL, value TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS cache_created ON cache (created)')
+        self.db.execute('DELETE FROM cache WHERE ott_version != ? OR created < ?',
+                        (ott_version, time.time() - ttl))
+        self.db.commit()
+        self.evict()
+
+    #source is the source of fuzzy matches (see name_source), for functions depending on it
+    @staticmethod
+    def make_key(function, query, context, taxfilter, source = None):
+        if source is None:
+            return json.dumps([function, query, context, taxfilter])
+        return json.dumps([function, query, context, taxfilter, source])
+
+    def get(self, function, query, context = None, taxfilter = None, source = None):
+        with self.lock:
+            row = self.db.execute('SELECT value, created FROM cache WHERE key = ? AND ott_version = ?',
+                                  (self.make_key(function, query, context, taxfilter, source), self.ott_version)).fetchone()
+        if row is None or row[1] < time.time() - self.ttl:
+            metrics.count('cache_misses', function)
+            return cache_miss
+        metrics.count('cache_hits', function)
+        return json.loads(row[0])
+
+    def put(self, function, query, value, context = None, taxfilter = None, source = None):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                            (self.make_key(function, query, context, taxfilter, source),
+                             self.ott_version,
+                             time.time(),
+                             json.dumps(value)))
+            self.db.commit()
+            self.puts += 1
+        if self.puts % 1000 == 0:
+            self.evict()
+
+    #delete oldest entries if cache is larger than max_entries
+    def evict(self):
+        with self.lock:
+            n_entries = self.db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+            if n_entries > self.max_entries:
+                self.db.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created LIMIT ?)',
+                                (n_entries - self.max_entries,))
+                self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+#cache used by the functions below. It is None unless opened with open_cache()
+resolution_cache = None
+#returned by cache_get() if a query is not in the cache, since None can be a cached result
+cache_miss = object()
+
+def open_cache(cache_dir, ott_version, ttl = 30 * 86400, max_entries = 1000000):
+    global resolution_cache
+    resolution_cache = ResolutionCache(cache_dir, ott_version, ttl = ttl, max_entries = max_entries)
+    return resolution_cache
+
+def cache_get(function, query, context = None, taxfilter = None, source = None):
+    if resolution_cache is None:
+        return cache_miss
+    return resolution_cache.get(function, query, context = context, taxfilter = taxfilter, source = source)
+
+def cache_put(function, query, value, context = None, taxfilter = None, source = None):
+    if resolution_cache is not None:
+        resolution_cache.put(function, query, value, context = context, taxfilter = taxfilter, source = source)
+
+#############################################
+#Limits to the number of simultaneous requests and requests per second sent to each remote service
+#Used as a context manager around each request, so they are respected when records are searched in parallel threads
+class RateLimiter:
+    def __init__(self, concurrency = None, rate = None):
+        self.set_limits(concurrency, rate)
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def set_limits(self, concurrency = None, rate = None):
+        self.semaphore = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self.interval = 1.0 / rate if rate else 0
+
+    def __enter__(self):
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        if self.interval:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.next_time - now
+                self.next_time = max(now, self.next_time) + self.interval
+            if wait > 0:
+                time.sleep(wait)
+        return self
+
+    def __exit__(self, *exc):
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+#one rate limiter per remote service, unlimited by default
+rate_limiters = {'otl_tnrs':RateLimiter(),
+                 'otl_taxonomy':RateLimiter(),
+                 'gn_resolver':RateLimiter()}
+
+#parses rate limits given in the command line as SERVICE=CONCURRENCY,REQUESTS_PER_SECOND
+#either limit can be left empty
+def parse_rate_limit(text):
+    try:
+        service, limits = text.split('=')
+        concurrency, rate = (limits.split(',') + [''])[:2]
+        concurrency = int(concurrency) if concurrency else None
+        rate = float(rate) if rate else None
+    except ValueError:
+        raise argparse.ArgumentTypeError('rate limits must be given as SERVICE=CONCURRENCY,REQUESTS_PER_SECOND')
+    if service not in rate_limiters:
+        raise argparse.ArgumentTypeError('service must be one of: ' + ', '.join(rate_limiters.keys()))
+    return service, concurrency, rate
+
+#############################################
+#HTTP client shared by all remote services
+#A single session keeps connections open between requests, instead of a new connection (and TLS handshake) per request
+#Failed requests are tried again after a wait that grows exponentially with the number of failures, with random jitter
+#so that parallel threads do not retry at the same time. If the service sends a Retry-After header, we wait as requested
+http_session = requests.Session()
+#base addresses of remote services, which can be changed to use a mirror or local stand-ins (see benchmarks)
+otl_api = 'https://api.opentreeoflife.org/v3'
+gn_api = 'http://resolver.globalnames.org'
+#seconds to wait for a connection and for a response
+http_timeout = (10, 120)
+#first and maximum wait between attempts, in seconds
+http_backoff = (1, 600)
+
+#sets timeouts, wait between attempts and number of pooled connections per host (should be at least the number of threads)
+def configure_http(timeout = 120, max_backoff = 600, pool_size = 10):
+    global http_timeout, http_backoff
+    http_timeout = (min(10, timeout), timeout)
+    http_backoff = (min(1, max_backoff), max_backoff)
+    adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = max(10, pool_size))
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+
+#Circuit breaker for a remote host
+#After failure_threshold consecutive failures, the circuit opens and all threads wait for reset_time seconds 
+#instead of sending more requests. After that, a single request is let through: if it succeeds, the circuit closes, 
+#otherwise it opens again for twice as long (up to the maximum wait between attempts)
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold = 5, reset_time = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_time = reset_time
+        self.open_time = reset_time
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    #waits while the circuit is open
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.failures < self.failure_threshold:
+                    return
+                if now >= self.open_until: #let a single request through, others keep waiting
+                    self.open_until = now + self.open_time
+                    return
+                wait = self.open_until - now
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.open_time = self.reset_time
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures == self.failure_threshold:
+                self.open_until = time.monotonic() + self.open_time
+                sys.stderr.write(time.ctime() + ': ' + str(self.failures) + ' consecutive errors with ' + self.name + 
+                                 ', pausing requests for ' + str(self.open_time) + ' seconds.\n')
+            elif self.failures > self.failure_threshold:
+                self.open_time = min(2 * self.open_time, http_backoff[1])
+                self.open_until = time.monotonic() + self.open_time
+
+#one circuit breaker per remote host
+circuit_breakers = {'otl':CircuitBreaker('Open Tree of Life'),
+                    'gn':CircuitBreaker('Global Names')}
+
+#raised by http_post() if max_tries is reached without a valid response
+class ServiceUnavailable(Exception):
+    pass
+
+#returns the number of seconds to wait given in a Retry-After header (either seconds or a date), or None
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+#sends a post request to a remote host, respecting the rate limits for the service and the circuit breaker for the host
+#requests are tried again until the response has one of the status codes in accept, or until max_tries (forever if None)
+#returns the response
+def http_post(host, service, url, json = None, accept = (200,), max_tries = None):
+    breaker = circuit_breakers[host]
+    tries = 0
+    while True:
+        breaker.wait()
+        wait = None
         try:
-            r = requests.post('https://api.opentreeoflife.org/v3/tnrs/match_names',
-                    json = {'names':[query, query],
-                            'do_approximate_matching':do_approximate,
-                            'context_name':context})
-        except (SSLError, ConnectionError):
-            sys.stderr.write(time.ctime() + ': ' + 
-                             'Error while connnecting to Open Tree of Life, will try again in ' + 
-                             str(wait_time) + ' seconds.')
-            time.sleep(wait_time)
-            continue
+            metrics.count('requests', service)
+            with rate_limiters[service]:
+                start = time.perf_counter()
+                r = http_session.post(url, json = json, timeout = http_timeout)
+        except (SSLError, ConnectionError, Timeout) as err:
+            error = 'Error while connecting to ' + breaker.name + ' (' + type(err).__name__ + ')'
+            if tracer is not None:
+                tracer.span(service, 'request', start, time.perf_counter(), error = type(err).__name__, attempt = tries + 1)
+        else:
+            if tracer is not None:
+                tracer.span(service, 'request', start, time.perf_counter(), status = r.status_code, attempt = tries + 1)
+            if r.status_code in accept:
+                breaker.success()
+                return r
+            error = 'Error with ' + breaker.name + ' response (status ' + str(r.status_code) + ')'
+            wait = retry_after(r)
+        
+        breaker.failure()
+        metrics.count('errors', service)
+        tries += 1
+        if max_tries is not None and tries >= max_tries:
+            raise ServiceUnavailable(error + ', giving up after ' + str(tries) + ' attempts.')
+        if wait is None:
+            wait = min(http_backoff[1], http_backoff[0] * 2 ** (tries - 1))
+            wait = random.uniform(wait / 2, wait)
+        metrics.count('retries', service)
+        sys.stderr.write(time.ctime() + ': ' + error + ', will try again in ' + str(round(wait, 1)) + ' seconds.\n')
+        start = time.perf_counter()
+        time.sleep(wait)
+        if tracer is not None:
+            tracer.span('backoff ' + service, 'wait', start, time.perf_counter())
+
+#############################################
+#Local index of an Open Tree Taxonomy release, used instead of the API with --offline-ott
+#A release (https://tree.opentreeoflife.org/about/taxonomy-version) is a folder including taxonomy.tsv and synonyms.tsv
+#These files are loaded once into a SQLite database saved in the same folder, and reused in later runs
+#Answers are given in the same format as the responses from the API
 
-        if r.status_code == 200:
-            contact_otl = False
+#names of the taxa corresponding to contexts in the Open Tree of Life TNRS API
+OTT_contexts = {'All life':'life',
+                'Bacteria':'Bacteria',
+                'SAR group':'SAR',
+                'Archaea':'Archaea',
+                'Excavata':'Excavata',
+                'Amoebozoa':'Amoebozoa',
+                'Centrohelida':'Centrohelida',
+                'Haptophyta':'Haptophyta',
+                'Apusozoa':'Apusozoa',
+                'Diatoms':'Bacillariophyta',
+                'Ciliates':'Ciliophora',
+                'Forams':'Foraminifera',
+                'Animals':'Metazoa',
+                'Birds':'Aves',
+                'Tetrapods':'Tetrapoda',
+                'Mammals':'Mammalia',
+                'Amphibians':'Amphibia',
+                'Vertebrates':'Vertebrata',
+                'Arthropods':'Arthropoda',
+                'Molluscs':'Mollusca',
+                'Nematodes':'Nematoda',
+                'Platyhelminthes':'Platyhelminthes',
+                'Annelids':'Annelida',
+                'Cnidarians':'Cnidaria',
+                'Arachnids':'Arachnida',
+                'Insects':'Insecta',
+                'Fungi':'Fungi',
+                'Basidiomycetes':'Basidiomycota',
+                'Ascomycetes':'Ascomycota',
+                'Land plants':'Embryophyta',
+                'Hornworts':'Anthocerotophyta',
+                'Mosses':'Bryophyta',
+                'Liverworts':'Marchantiophyta',
+                'Vascular plants':'Tracheophyta',
+                'Club mosses':'Lycopodiophyta',
+                'Ferns':'Moniliformopses',
+                'Seed plants':'Spermatophyta',
+                'Flowering plants':'Magnoliophyta',
+                'Monocots':'Liliopsida',
+                'Eudicots':'eudicotyledons',
+                'Rosids':'rosids',
+                'Asterids':'asterids',
+                'Asterales':'Asterales',
+                'Asteraceae':'Asteraceae',
+                'Aster':'Aster',
+                'Symphyotrichum':'Symphyotrichum',
+                'Campanulaceae':'Campanulaceae',
+                'Lobelia':'Lobelia'}
+
+#taxa with these flags are not returned by name searches in the API
+OTT_suppressed_flags = {'not_otu', 'environmental', 'environmental_inherited', 'viral',
+                        'hidden', 'hidden_inherited', 'was_container'}
+
+#helper function to read a line of the OTT tsv files, in which columns are separated by '\t|\t'
+#each line also ends with '\t|\t' or '\t|'
+def split_OTT_line(line):
+    line = line.rstrip('\n')
+    if line.endswith('\t|\t'):
+        line = line[:-3]
+    elif line.endswith('\t|'):
+        line = line[:-2]
+    return line.split('\t|\t')
+
+class OTTIndex:
+    def __init__(self, path):
+        if os.path.isdir(path):
+            self.ott_dir = path
+            self.path = os.path.join(path, 'TaxReformer_index.sqlite')
         else:
-            sys.stderr.write(time.ctime() + ': ' + 
-                             'Error with Open Tree of Life response, will try again in ' + 
-                             str(wait_time) + ' seconds.')
-            time.sleep(wait_time)
-            continue
-    return r
+            self.ott_dir = os.path.dirname(path)
+            self.path = path
+        self.lock = threading.Lock()
+        self.lineages = {}
+        self.context_ids = {}
 
-#this function is a wrapper for taxonomy in otl api v3.
-#if service returns an error code, it pauses execution and tries again  in wait_time seconds
-#(useful if making a number of requests that can pass the api daily limit)
-def otl_taxon(query, wait_time = 600, ncbi = False):
-    contact_otl = True
-    while contact_otl:
+        if not os.path.isfile(self.path):
+            self.build()
+        self.db = sqlite3.connect(self.path, check_same_thread = False)
+        self.version = self.db.execute("SELECT value FROM info WHERE key = 'version'").fetchone()[0]
+        #indices built by older versions of TaxReformer do not have the crosswalk of ncbi ids
+        if not self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'ncbi'").fetchone():
+            sys.stderr.write('Adding NCBI ids to index for Open Tree Taxonomy in ' + self.path + '.\n')
+            self.build_ncbi(self.db)
+
+    #reads taxonomy.tsv and synonyms.tsv and saves them in the index
+    def build(self):
+        sys.stderr.write('Building index for Open Tree Taxonomy in ' + self.path + ', this might take a while.\n')
+        temp_path = self.path + '.tmp'
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        db = sqlite3.connect(temp_path)
+        db.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+        db.execute('''CREATE TABLE taxa (uid INTEGER PRIMARY KEY, parent INTEGER, name TEXT, rank TEXT,
+                                         sourceinfo TEXT, uniqname TEXT, flags TEXT)''')
+        db.execute('CREATE TABLE synonyms (name TEXT, uid INTEGER)')
+
+        with open(os.path.join(self.ott_dir, 'taxonomy.tsv')) as infile:
+            header = split_OTT_line(next(infile))
+            cols = [header.index(col) for col in ['uid','parent_uid','name','rank','sourceinfo','uniqname','flags']]
+            rows = []
+            for line in infile:
+                fields = split_OTT_line(line)
+                rows.append(tuple(fields[col] for col in cols))
+                if len(rows) >= 100000:
+                    db.executemany('INSERT INTO taxa VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                    rows = []
+            db.executemany('INSERT INTO taxa VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+        with open(os.path.join(self.ott_dir, 'synonyms.tsv')) as infile:
+            header = split_OTT_line(next(infile))
+            cols = [header.index(col) for col in ['name','uid']]
+            rows = []
+            for line in infile:
+                fields = split_OTT_line(line)
+                rows.append(tuple(fields[col] for col in cols))
+                if len(rows) >= 100000:
+                    db.executemany('INSERT INTO synonyms VALUES (?, ?)', rows)
+                    rows = []
+            db.executemany('INSERT INTO synonyms VALUES (?, ?)', rows)
+
+        db.execute('CREATE INDEX taxa_name ON taxa (name COLLATE NOCASE)')
+        db.execute('CREATE INDEX synonyms_name ON synonyms (name COLLATE NOCASE)')
+        self.build_ncbi(db)
+
+        #version is recorded in the same format as /v3/taxonomy/about
         try:
-            if ncbi:
-                r = requests.post('https://api.opentreeoflife.org/v3/taxonomy/taxon_info',
-                    json = {'source_id':'ncbi:' + str(query), #id for taxon being searched
-                            'include_lineage':True}) #include higher taxa
+            with open(os.path.join(self.ott_dir, 'version.txt')) as infile:
+                version = infile.read().strip()
+        except IOError:
+            version = os.path.basename(os.path.normpath(self.ott_dir))
+        if not version.startswith('ott'):
+            version = 'ott' + version
+        db.execute('INSERT INTO info VALUES (?, ?)', ('version', version))
+        db.commit()
+        db.close()
+        os.rename(temp_path, self.path)
+
+    #crosswalk between ncbi ids and ott ids, read from the sources of each taxon (for example, ncbi:9606,gbif:2436436)
+    #indexed in both directions. The same ncbi id can be a source of more than one ott taxon
+    @staticmethod
+    def build_ncbi(db):
+        db.execute('CREATE TABLE ncbi (ncbi INTEGER, uid INTEGER)')
+        rows = []
+        for uid, sourceinfo in db.execute("SELECT uid, sourceinfo FROM taxa WHERE sourceinfo LIKE '%ncbi:%'").fetchall():
+            for source in sourceinfo.split(','):
+                if source.startswith('ncbi:'):
+                    try:
+                        rows.append((int(source[5:]), uid))
+                    except ValueError:
+                        pass
+        db.executemany('INSERT INTO ncbi VALUES (?, ?)', rows)
+        db.execute('CREATE INDEX ncbi_ncbi ON ncbi (ncbi)')
+        db.execute('CREATE INDEX ncbi_uid ON ncbi (uid)')
+        db.commit()
+
+    #ott id for an ncbi id, or None if not found
+    #if more than one taxon has this id as a source, the first one not suppressed is used
+    def ncbi_to_ott(self, ncbi_id):
+        with self.lock:
+            rows = self.db.execute('SELECT taxa.uid, taxa.flags FROM ncbi JOIN taxa ON ncbi.uid = taxa.uid WHERE ncbi.ncbi = ? ORDER BY taxa.uid',
+                                   (int(ncbi_id),)).fetchall()
+        if not rows:
+            return None
+        for uid, flags in rows:
+            if not any(flag in OTT_suppressed_flags for flag in flags.split(',')):
+                return uid
+        return rows[0][0]
+
+    #ncbi id for an ott id (as a string, as in the sources of a taxon), or None if the taxon is not in ncbi
+    #if the taxon has more than one ncbi id, the first one listed in its sources is used, as in list2dict()
+    def ott_to_ncbi(self, uid):
+        with self.lock:
+            row = self.db.execute('SELECT ncbi FROM ncbi WHERE uid = ? ORDER BY rowid LIMIT 1', (uid,)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def get_taxon(self, uid):
+        with self.lock:
+            row = self.db.execute('SELECT uid, parent, name, rank, sourceinfo, uniqname, flags FROM taxa WHERE uid = ?',
+                                  (uid,)).fetchone()
+        if row is None:
+            return None
+        return self.taxon_dict(row)
+
+    #taxon in the same format as the API
+    @staticmethod
+    def taxon_dict(row):
+        uid, parent, name, rank, sourceinfo, uniqname, flags = row
+        flags = [flag for flag in flags.split(',') if flag]
+        return {'ott_id':uid,
+                'parent':parent,
+                'name':name,
+                'rank':rank,
+                'tax_sources':[source for source in sourceinfo.split(',') if source],
+                'unique_name':uniqname if uniqname else name,
+                'flags':flags,
+                'is_suppressed':any(flag in OTT_suppressed_flags for flag in flags)}
+
+    #returns the list of higher taxa for a taxon, from its parent to the root
+    def lineage(self, uid):
+        try:
+            return self.lineages[uid]
+        except KeyError:
+            pass
+
+        taxon = self.get_taxon(uid)
+        if taxon is None or not taxon['parent']:
+            lineage = []
+        else:
+            parent = self.get_taxon(taxon['parent'])
+            lineage = [parent] + self.lineage(parent['ott_id'])
+
+        if len(self.lineages) >= 100000:
+            self.lineages.clear()
+        self.lineages[uid] = lineage
+        return lineage
+
+    #ott_id for the taxon corresponding to a TNRS context
+    def context_id(self, context):
+        if context not in self.context_ids:
+            name = OTT_contexts.get(context, context)
+            with self.lock:
+                rows = self.db.execute('SELECT uid, parent, name, rank, sourceinfo, uniqname, flags FROM taxa WHERE name = ?',
+                                       (name,)).fetchall()
+            if rows:
+                #if there are homonyms, use the one closest to the root
+                self.context_ids[context] = min((self.taxon_dict(row) for row in rows),
+                                                key = lambda x: len(self.lineage(x['ott_id'])))['ott_id']
             else:
-                r = requests.post('https://api.opentreeoflife.org/v3/taxonomy/taxon_info',
-                                json = {"ott_id":query, #id for taxon being searched
-                                        "include_lineage":True}) #include higher taxa
-        except (SSLError, ConnectionError):
-            sys.stderr.write(time.ctime() + ': ' + 
-                             'Error while connnecting to Open Tree of Life, will try again in ' + 
-                             str(wait_time) + 
-                             ' seconds.')
-            time.sleep(wait_time)
-            continue
+                warnings.warn('Context ' + str(context) + ' not found in local Open Tree Taxonomy, searching all life.')
+                self.context_ids[context] = None
+        return self.context_ids[context]
 
-        if r.status_code == 200:
-            contact_otl = False
-        elif r.status_code == 400:
-            contact_otl = False
-            sys.stderr.write(r.json()['message'])
-            sys.stderr.write('skipping')
+    def in_context(self, taxon, context_id):
+        if context_id is None or taxon['ott_id'] == context_id:
+            return True
+        return any(higher['ott_id'] == context_id for higher in self.lineage(taxon['ott_id']))
+
+    #exact matches for a name, in the format of /v3/tnrs/match_names
+    def match_name(self, name, context_id):
+        with self.lock:
+            accepted = self.db.execute('SELECT uid, parent, name, rank, sourceinfo, uniqname, flags FROM taxa WHERE name = ? COLLATE NOCASE ORDER BY uid',
+                                       (name,)).fetchall()
+            synonyms = self.db.execute('SELECT name, uid FROM synonyms WHERE name = ? COLLATE NOCASE ORDER BY uid',
+                                       (name,)).fetchall()
+
+        matches = []
+        for row in accepted:
+            matches.append((row[2], False, self.taxon_dict(row)))
+        for synonym, uid in synonyms:
+            taxon = self.get_taxon(uid)
+            if taxon is not None:
+                matches.append((synonym, True, taxon))
+
+        results = []
+        for matched_name, is_synonym, taxon in matches:
+            if taxon['is_suppressed'] or not self.in_context(taxon, context_id):
+                continue
+            del taxon['parent']
+            results.append({'matched_name':matched_name,
+                            'is_synonym':is_synonym,
+                            'is_approximate_match':False,
+                            'score':1.0,
+                            'search_string':name,
+                            'taxon':taxon})
+        return results
+
+    def match_names(self, names, context):
+        context_id = self.context_id(context)
+        response = {'results':[], 'unmatched_names':[], 'context':context}
+        for name in dict.fromkeys(names):
+            matches = self.match_name(name, context_id)
+            if matches:
+                response['results'].append({'name':name, 'matches':matches})
+            else:
+                response['unmatched_names'].append(name)
+        return response
+
+    #taxon and its lineage, in the format of /v3/taxonomy/taxon_info
+    def taxon_info(self, ott_id):
+        taxon = self.get_taxon(ott_id)
+        if taxon is None:
             return None
+        taxon['lineage'] = []
+        for higher in self.lineage(ott_id):
+            higher = dict(higher)
+            del higher['parent']
+            taxon['lineage'].append(higher)
+        del taxon['parent']
+        return taxon
+
+    #yields all names of taxa and synonyms within a context, as (name, ott_id, is_synonym)
+    #suppressed taxa are skipped, as in name searches
+    def iter_names(self, context):
+        context_id = self.context_id(context)
+        with self.lock:
+            self.db.execute('CREATE INDEX IF NOT EXISTS taxa_parent ON taxa (parent)')
+            if context_id is None:
+                rows = self.db.execute('SELECT uid, name, flags FROM taxa').fetchall()
+            else:
+                rows = self.db.execute('''WITH RECURSIVE subtree(uid) AS (SELECT ? UNION ALL
+                                              SELECT taxa.uid FROM taxa JOIN subtree ON taxa.parent = subtree.uid)
+                                          SELECT taxa.uid, taxa.name, taxa.flags FROM taxa JOIN subtree ON taxa.uid = subtree.uid''',
+                                       (context_id,)).fetchall()
+        uids = set()
+        for uid, name, flags in rows:
+            if not any(flag in OTT_suppressed_flags for flag in flags.split(',')):
+                uids.add(uid)
+                yield name, uid, False
+        del rows
+
+        with self.lock:
+            synonyms = self.db.execute('SELECT name, uid FROM synonyms').fetchall()
+        for name, uid in synonyms:
+            if uid in uids:
+                yield name, uid, True
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+#local taxonomy used by the functions below. It is None unless opened with open_ott_index()
+ott_index = None
+
+def open_ott_index(path):
+    global ott_index
+    ott_index = OTTIndex(path)
+    return ott_index
+
+#returns the version of Open Tree Taxonomy being used, as reported by /v3/taxonomy/about
+def ott_taxonomy_version():
+    if ott_index is not None:
+        return ott_index.version
+    return http_post('otl', 'otl_taxonomy', otl_api + '/taxonomy/about').json()['source']
+
+#this function is a wrapper for taxonomic resolution services in otl api v3.
+#if service returns an error code, it pauses execution and tries again (see http_post)
+#(useful if making a number of requests that can pass the api daily limit)
+#query can be a single name or a list of names to be matched in a single request
+#returns the decoded json response
+@timed('otl_tnrs')
+def otl_tnrs(query, do_approximate = True, context = 'Arthropods'):
+    cache_function = 'otl_tnrs_approximate' if do_approximate else 'otl_tnrs'
+    if isinstance(query, list):
+        names = query
+    else:
+        names = [query, query]
+    
+    #local taxonomy only does exact matches
+    if ott_index is not None:
+        return ott_index.match_names(names, context)
+
+    if not isinstance(query, list):
+        cached = cache_get(cache_function, query, context = context)
+        if cached is not cache_miss:
+            return cached
+
+    r = http_post('otl', 'otl_tnrs', otl_api + '/tnrs/match_names',
+                  json = {'names':names,
+                          'do_approximate_matching':do_approximate,
+                          'context_name':context})
+
+    response = r.json()
+    if not isinstance(query, list):
+        cache_put(cache_function, query, response, context = context)
+    return response
+
+#this function is a wrapper for taxonomy in otl api v3.
+#if service returns an error code, it pauses execution and tries again (see http_post)
+#(useful if making a number of requests that can pass the api daily limit)
+#returns the decoded json response, or None if the taxon was not found
+#with ncbi = True, query is an ncbi id
+@timed('otl_taxon')
+def otl_taxon(query, ncbi = False):
+    if ott_index is not None:
+        if ncbi:
+            query = ott_index.ncbi_to_ott(query)
+            if query is None:
+                return None
+        return ott_index.taxon_info(query)
+    
+    cache_function = 'otl_taxon_ncbi' if ncbi else 'otl_taxon'
+    cached = cache_get(cache_function, query)
+    if cached is not cache_miss:
+        return cached
+
+    if ncbi:
+        payload = {'source_id':'ncbi:' + str(query), #id for taxon being searched
+                   'include_lineage':True} #include higher taxa
+    else:
+        payload = {"ott_id":query, #id for taxon being searched
+                   "include_lineage":True} #include higher taxa
+    r = http_post('otl', 'otl_taxonomy', otl_api + '/taxonomy/taxon_info',
+                  json = payload, accept = (200, 400))
+
+    if r.status_code == 400:
+        sys.stderr.write(r.json()['message'])
+        sys.stderr.write('skipping')
+        return None
+
+    response = r.json()
+    cache_put(cache_function, query, response)
+    return response
+
+
+#Exact matches already obtained in batch by otl_tnrs_batch(), keyed by (name, context)
+#Filled by prefetch_names() for a window of records and consumed by otl_exact_match()
+otl_prefetched = {}
+#prefetched results are discarded when there are more than this number, 
+#instead of after each window, since records of the previous window might still be searched in other threads
+prefetch_limit = 100000
+
+#this function sends many names to otl tnrs without approximate matching, chunk_size names per request
+#returns a dictionary keyed by name with the list of matches for each name (empty list if not found)
+#names in the persistent cache are not sent, and results are cached for each name as if searched individually
+def otl_tnrs_batch(queries, context = 'Arthropods', chunk_size = 500):
+    matches = {}
+    to_search = []
+    for query in dict.fromkeys(queries): #remove duplicates, keeping order
+        cached = cache_get('otl_tnrs', query, context = context)
+        if cached is cache_miss:
+            to_search.append(query)
+        elif cached['results']:
+            matches[query] = cached['results'][0]['matches']
         else:
-            sys.stderr.write(time.ctime() + ': ' +
-                             'Error while contacting Open Tree of Life, will try again in ' + 
-                             str(wait_time) + ' seconds.')
-            time.sleep(wait_time)
-    return r
+            matches[query] = []
+
+    for start in range(0, len(to_search), chunk_size):
+        chunk = to_search[start:start + chunk_size]
+        response = otl_tnrs(chunk, do_approximate = False, context = context)
+        found = {result['name']:result for result in response['results']}
+        for query in chunk:
+            if query in found:
+                matches[query] = found[query]['matches']
+                cache_put('otl_tnrs', query, {'results':[found[query]]}, context = context)
+            else:
+                matches[query] = []
+                cache_put('otl_tnrs', query, {'results':[]}, context = context)
+    return matches
+
+#returns the list of exact matches in otl tnrs for a name, using results prefetched in batch if available
+def otl_exact_match(query, context):
+    try:
+        return otl_prefetched[(query, context)]
+    except KeyError:
+        pass
+    
+    response = otl_tnrs(query, do_approximate = False, context = context)
+    if response['results']:
+        return response['results'][0]['matches']
+    else:
+        return []
+
+#Exact matches for genus names, keyed by (genus, context)
+#Many species share the same genus, so genus fallbacks are memoized and threads searching the same genus share a single request
+genus_matches = BoundedMemo()
+genus_matches_flight = SingleFlight('genus_match')
 
+#returns the list of exact matches in otl tnrs for a genus name
+def otl_genus_match(genus, context):
+    key = (genus, context)
+    try:
+        matches = genus_matches[key]
+        metrics.count('memory_hits', 'genus_match')
+        return matches
+    except KeyError:
+        pass
+    
+    matches = genus_matches_flight.do(key, otl_exact_match, genus, context)
+    genus_matches[key] = matches
+    return matches
 
 #helper function that parses ott taxonmy source results to a dictionary
+#if a taxon has more than one id from the same source, the first one is kept, as in OTTIndex.ott_to_ncbi()
 def list2dict(taxlist):
-    return {x.split(':')[0]:x.split(':')[1] for x in taxlist}
+    out = {}
+    for x in taxlist:
+        out.setdefault(x.split(':')[0], x.split(':')[1])
+    return out
+
+#returns the ncbi id of a taxon from ott (as in the api, with key tax_sources), or None if not in ncbi
+#with a local taxonomy, the id is read from the crosswalk in the index instead of parsing the list of sources
+def taxon_ncbi_id(taxon):
+    if ott_index is not None:
+        return ott_index.ott_to_ncbi(taxon['ott_id'])
+    return list2dict(taxon.get('tax_sources', [])).get('ncbi')
+
+#Higher taxonomy already obtained by taxonomy_OTT(), keyed by ott_id
+#Many records share the same genus, so this avoids requesting and parsing the same lineage again
+taxonomy_OTT_results = BoundedMemo()
+taxonomy_OTT_flight = SingleFlight('taxonomy_OTT')
 
 #This function uses Open Tree of Life API version 3(https://github.com/OpenTreeOfLife/germinator/wiki/Taxonomy-API-v3)
 #Given a genus name, it returns its taxonomy up to order in a dictionary, and the ott_id for the genus
-def taxonomy_OTT(ott_id = None):  
+@timed('taxonomy_OTT')
+def taxonomy_OTT(ott_id = None):
+    try:
+        out_dict = dict(taxonomy_OTT_results[ott_id])
+        metrics.count('memory_hits', 'taxonomy_OTT')
+        return out_dict
+    except KeyError:
+        pass
+    
+    out_dict = taxonomy_OTT_flight.do(ott_id, taxonomy_OTT_uncached, ott_id)
+    taxonomy_OTT_results[ott_id] = out_dict
+    return dict(out_dict)
+
+def taxonomy_OTT_uncached(ott_id = None):  
     #now, get taxonomic information
-    r = otl_taxon(ott_id, wait_time = 3600)    
+    #the response is decoded only once by otl_taxon()
+    taxon = otl_taxon(ott_id)    
 
     #save all higher taxa in dict, keyed by ranks
-    out_dict = {('tax_' + higher['rank']):higher['name'] for higher in r.json()['lineage']}
+    #names of higher taxa are repeated for many records, so a single copy of each string is kept
+    out_dict = {sys.intern('tax_' + higher['rank']):sys.intern(higher['name']) for higher in taxon['lineage']}
     out_dict['tax_higher_source'] = 'OTT'
-    out_dict['rank'] = r.json()['rank']
+    out_dict['rank'] = taxon['rank']
     #remove unnecessary ranks
     for rank in ['tax_no rank']:
         out_dict.pop(rank,0)
@@ -142,35 +1221,38 @@ def taxonomy_OTT(ott_id = None):
     #add genus ott_id and ncbi_id to output dictionary, if species-level
     #or just ott_id and ncbi_id for taxon if not species-level
     out_dict['tax_ott_id'] = ott_id
-    out_dict['tax_ott_accepted_name'] = r.json()['name'] #the searched genus might be a synonym, so we also keep the updated name according OTT
-    try:
-        out_dict.update({'tax_ncbi_id':list2dict(r.json()['tax_sources'])['ncbi']})
-    except KeyError:
-        pass
+    out_dict['tax_ott_accepted_name'] = taxon['name'] #the searched genus might be a synonym, so we also keep the updated name according OTT
+    ncbi_id = taxon_ncbi_id(taxon)
+    if ncbi_id is not None:
+        out_dict['tax_ncbi_id'] = ncbi_id
     
     #if species or subspecies, add genus information
-    if r.json()['rank'] in ['species','subspecies']:
+    if taxon['rank'] in ['species','subspecies']:
         try:
-            genus_tax = [tax for tax in r.json()['lineage'] if tax['rank'] == 'genus'][0]
+            genus_tax = [tax for tax in taxon['lineage'] if tax['rank'] == 'genus'][0]
         except IndexError:
             out_dict['tax_cg_ott_id'] = nan
             if out_dict['rank'] in ['species', 'subspecies']:
-                out_dict['cg'] = r.json()['unique_name'].split()[0]
+                out_dict['cg'] = taxon['unique_name'].split()[0]
         else:
             out_dict['tax_cg_ott_id'] = genus_tax['ott_id']
             out_dict['cg'] = out_dict['tax_genus']
             del out_dict['tax_genus']
-            try:
-                out_dict.update({'tax_cg_ncbi_id':list2dict(genus_tax['tax_sources'])['ncbi']})
-            except KeyError:
-                pass
+            ncbi_id = taxon_ncbi_id(genus_tax)
+            if ncbi_id is not None:
+                out_dict['tax_cg_ncbi_id'] = ncbi_id
+            #else:
                 #warnings.warn('Genus ' + out_dict['cg'] +  ' not in ncbi!')
     #if subspecific rank, update ids ofr species
     try:
-        species_tax = [tax for tax in r.json()['lineage'] if tax['rank'] == 'species'][0]
+        species_tax = [tax for tax in taxon['lineage'] if tax['rank'] == 'species'][0]
         out_dict['tax_cs_ott_id'] = species_tax['ott_id']
     except:
         pass
+    else:
+        ncbi_id = taxon_ncbi_id(species_tax)
+        if ncbi_id is not None:
+            out_dict['tax_cs_ncbi_id'] = ncbi_id
     
     try:
         del out_dict['tax_species']
@@ -188,12 +1270,32 @@ def taxonomy_OTT(ott_id = None):
 #currently accepted name, id on taxonomic service, level , taxonomic source and higher_taxonomy
 #All of them should also check if the name is an arthropod
 #If name not found as genus or species, it should return None
+
+#Results of otl_checkname() are kept in memory, keyed by (name, context)
+#It is mostly used for genus fallbacks, repeated for every species of a genus found outside OTT,
+#and threads checking the same name at the same time share a single search
+otl_checkname_results = BoundedMemo()
+otl_checkname_flight = SingleFlight('otl_checkname')
+
 def otl_checkname(query, context):
+    key = (query, context)
+    try:
+        outdict = otl_checkname_results[key]
+        metrics.count('memory_hits', 'otl_checkname')
+        return outdict
+    except KeyError:
+        pass
+    
+    outdict = otl_checkname_flight.do(key, otl_checkname_uncached, query, context)
+    otl_checkname_results[key] = outdict
+    return outdict
+
+def otl_checkname_uncached(query, context):
     outdict = None
     
-    r = otl_tnrs(query, do_approximate = False, context = context)
-    if r.json()['results']:
-        result = r.json()['results'][0]['matches'][0]
+    matches = otl_exact_match(query, context)
+    if matches:
+        result = matches[0]
         outdict = {'current_name': result['taxon']['name'], 
                    'id': result['taxon']['ott_id'], 
                    'name_source': 'OTT'}
@@ -201,10 +1303,9 @@ def otl_checkname(query, context):
 
         if result['taxon']['rank'] == 'species':
             outdict['level'] = 'species'
-            try: 
-                outdict['ncbi_id'] = list2dict(result['taxon']['tax_sources'])['ncbi']
-            except:
-                pass
+            ncbi_id = taxon_ncbi_id(result['taxon'])
+            if ncbi_id is not None:
+                outdict['ncbi_id'] = ncbi_id
             
         elif result['taxon']['rank'] == 'genus':
             outdict['level'] = 'genus'
@@ -246,68 +1347,295 @@ def parse_GN_classpath(GN_result):
         
     return {'tax_level':this_rank, 'higher_taxonomy':taxdict}
                
-#Function to do fuzzy search in Global Names
-def fuzzy_search_GN(full_name, taxfilter):
-    #start by fuzzy searching Global Names
-    results_with_classpath = []
-    all_results = []    
-    trycounter = 0
-    
-    while trycounter < 10:
-        try:
-            r = requests.post('http://resolver.globalnames.org/name_resolvers.json',
-                                json = {'names':full_name, #searching for genus + species first to avoid homonyms 
-                                        'best_match_only':'false'})
-            break
-        except ConnectionError as err:
-            trycounter += 1
-            sys.stderr.write(err + '\n' + 'Trying again')
+#############################################
+#Local fuzzy name matching, used instead of Global Names with --local-names
+#Names come from a checklist provided by the user or from a local release of Open Tree Taxonomy (see --offline-ott)
+#Candidates are found with an index of trigrams restricted to names of similar length, and scored by edit distance
+#Results are returned in the same format as Global Names, so the same filters and choice of best result are applied
+
+#python-Levenshtein is installed with fuzzywuzzy in the docker image, but we do not require it
+try:
+    from Levenshtein import distance as edit_distance
+except ImportError:
+    def edit_distance(name1, name2):
+        previous = list(range(len(name2) + 1))
+        for i, char1 in enumerate(name1, 1):
+            current = [i]
+            for j, char2 in enumerate(name2, 1):
+                current.append(min(previous[j] + 1,
+                                   current[j - 1] + 1,
+                                   previous[j - 1] + (char1 != char2)))
+            previous = current
+        return previous[-1]
+
+def name_trigrams(name):
+    padded = '  ' + name + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class LocalNameMatcher:
+    #data source id reported for names from Open Tree Taxonomy, the same used by Global Names
+    OTT_source_id = 179
+    #data source id reported for names from a checklist provided by the user
+    checklist_source_id = 0
+
+    def __init__(self, min_score = 0.75, max_candidates = 50):
+        self.min_score = min_score
+        self.max_candidates = max_candidates
+        self.source = 'local' #identifies the names used, in keys of the persistent cache
+        self.entries = [] #(lowercase name, name, data source id, reference), reference is ott_id for OTT or dict with classification
+        self.ott_index = None
+
+    def add_name(self, name, data_source_id, reference = None):
+        self.entries.append((name.lower(), name, data_source_id, reference))
+
+    #reads a checklist with one name per line, or a tab-separated table with a header including a column 'name'
+    #optional columns: current_name, classification_path, classification_path_ranks and data_source_id
+    @classmethod
+    def from_checklist(cls, path, **kwargs):
+        matcher = cls(**kwargs)
+        matcher.source = 'checklist:' + os.path.abspath(path) + ':' + str(os.path.getmtime(path))
+        with open(path) as infile:
+            lines = (line.rstrip('\n') for line in infile)
+            first_line = next(lines, '')
+            header = first_line.split('\t')
+            if 'name' not in header:
+                header = None
+                lines = itertools.chain([first_line], lines)
+            for line in lines:
+                if not line.strip():
+                    continue
+                if header is None:
+                    matcher.add_name(line.strip(), cls.checklist_source_id)
+                else:
+                    row = dict(zip(header, line.split('\t')))
+                    matcher.add_name(row['name'],
+                                     int(row.get('data_source_id') or cls.checklist_source_id),
+                                     {key:row[key] for key in ['current_name','classification_path','classification_path_ranks'] if row.get(key)})
+        matcher.build()
+        return matcher
+
+    #uses all names and synonyms within the context in the local Open Tree Taxonomy
+    @classmethod
+    def from_ott_index(cls, index, context, **kwargs):
+        matcher = cls(**kwargs)
+        matcher.ott_index = index
+        matcher.source = 'OTT:' + index.version + ':' + str(context)
+        for name, uid, is_synonym in index.iter_names(context):
+            matcher.add_name(name, cls.OTT_source_id, uid)
+        matcher.build()
+        return matcher
+
+    #names are sorted by length, so that the postings of each trigram can be restricted to names of similar length by bisection
+    def build(self):
+        self.entries.sort(key = lambda x: len(x[0]))
+        self.length_starts = []
+        self.trigrams = {}
+        for i, entry in enumerate(self.entries):
+            while len(self.length_starts) <= len(entry[0]):
+                self.length_starts.append(i)
+            for trigram in name_trigrams(entry[0]):
+                self.trigrams.setdefault(trigram, array.array('I')).append(i)
+        self.length_starts.append(len(self.entries))
+
+    def first_with_length(self, length):
+        if length < 0:
+            return 0
+        if length >= len(self.length_starts):
+            return len(self.entries)
+        return self.length_starts[length]
+
+    #returns result in the format of one item of 'data' in Global Names responses
+    def search(self, query):
+        query_lower = query.lower()
+        #the score is relative to the longer name, so names up to len(query) / min_score long can still reach min_score
+        #and the edit distance allowed for them is larger than for names as long as the query
+        max_length = int(len(query_lower) / self.min_score)
+        max_distance = int(max_length * (1 - self.min_score))
+        start = self.first_with_length(len(query_lower) - int(len(query_lower) * (1 - self.min_score)))
+        end = self.first_with_length(max_length + 1)
+
+        #count shared trigrams for names with similar length
+        shared = collections.Counter()
+        query_trigrams = name_trigrams(query_lower)
+        for trigram in query_trigrams:
+            posting = self.trigrams.get(trigram)
+            if posting:
+                shared.update(posting[bisect.bisect_left(posting, start):bisect.bisect_left(posting, end)])
+
+        #each edit changes at most three trigrams
+        min_shared = len(query_trigrams) - 3 * max_distance
+        results = []
+        for i, n_shared in shared.most_common(self.max_candidates):
+            if n_shared < min_shared:
+                break
+            name_lower, name, data_source_id, reference = self.entries[i]
+            score = 1 - edit_distance(query_lower, name_lower) / max(len(query_lower), len(name_lower))
+            if score >= self.min_score:
+                results.append(self.result_dict(name, data_source_id, reference, round(score, 3)))
+
+        results.sort(key = lambda x: -x['score'])
+        GN_data = {'supplied_name_string':query}
+        if results:
+            GN_data['results'] = results
+        return GN_data
+
+    def result_dict(self, name, data_source_id, reference, score):
+        result = {'name_string':name,
+                  'canonical_form':name,
+                  'current_name_string':name,
+                  'data_source_id':data_source_id,
+                  'score':score,
+                  'match_type':1 if score == 1 else 3,
+                  'classification_path':None,
+                  'classification_path_ranks':None}
+        if data_source_id == self.OTT_source_id and self.ott_index is not None:
+            taxon = self.ott_index.get_taxon(reference)
+            path = [higher for higher in reversed(self.ott_index.lineage(reference)) if higher['parent']] + [taxon]
+            result['current_name_string'] = taxon['name']
+            result['classification_path'] = '|'.join(higher['name'] for higher in path)
+            result['classification_path_ranks'] = '|'.join(higher['rank'] if higher['rank'] != 'no rank' else '' for higher in path)
+            result['classification_path_ids'] = '|'.join(str(higher['ott_id']) for higher in path)
+        elif reference:
+            result['current_name_string'] = reference.get('current_name', name)
+            result['classification_path'] = reference.get('classification_path')
+            result['classification_path_ranks'] = reference.get('classification_path_ranks')
+        return result
+
+#local name matcher used by fuzzy_search_GN(). It is None unless opened with open_local_names()
+local_matcher = None
+
+#path can be a checklist, or 'OTT' to use names in the local Open Tree Taxonomy
+def open_local_names(path, context = 'All life'):
+    global local_matcher
+    sys.stderr.write('Loading names for local fuzzy matching.\n')
+    if path == 'OTT':
+        if ott_index is None:
+            raise Exception('Local names from Open Tree Taxonomy require --offline-ott.')
+        local_matcher = LocalNameMatcher.from_ott_index(ott_index, context)
     else:
-        'More than 10 failed connection attempts, skipping.'
-        return None
+        local_matcher = LocalNameMatcher.from_checklist(path)
+    return local_matcher
+
+#returns the source of fuzzy matches: 'gn' for Global Names, or the names used by the local matcher
+#results depending on it are cached separately for each source, so that runs with and without local names do not mix
+def name_source():
+    if local_matcher is None:
+        return 'gn'
+    return local_matcher.source
+
+#Results of fuzzy_search_GN already obtained by prefetch_names(), keyed by (name, taxfilter)
+GN_prefetched = {}
+
+#preferred sources when Global Names results have the same score: OTT, NCBI and GBIF, in this order
+GN_source_priority = {179:0, 4:1, 11:2}
+
+#Function to choose the best result from Global Names for a single name
+#Takes as input the item of the 'data' list returned by Global Names for that name
+def choose_GN_result(GN_data, taxfilter):
+    #best result among all results, and among results with a classification path including taxfilter
+    #as [score, priority, result], updated in a single pass over results
+    best_all = None
+    best_filtered = None
     
-    #save only results with a classification path including taxfilter               
-    if 'results' in list(r.json()['data'][0].keys()):
-        for result in r.json()['data'][0]['results']:
-            all_results.append(result)
+    if 'results' in GN_data:
+        for result in GN_data['results']:
+            score = result['score']
+            priority = GN_source_priority.get(result['data_source_id'], len(GN_source_priority))
+            if best_all is None or score > best_all[0] or (score == best_all[0] and priority < best_all[1]):
+                best_all = [score, priority, result]
 
             if taxfilter and \
-            'classification_path' in list(result.keys()) and \
-            result['classification_path'] is not None and \
+            result.get('classification_path') is not None and \
             taxfilter in result['classification_path']:
-                results_with_classpath.append(result)
+                if best_filtered is None or score > best_filtered[0] or (score == best_filtered[0] and priority < best_filtered[1]):
+                    best_filtered = [score, priority, result]
 
     #now we choose what to search for an exact match in ott
     #if we could filter results, we choose the best of them
     #and we check if we found only genus or genus + species
     #if we did not have a classification path, we proceed with the best result regardless
     #and if there is no results, we pass None
-    if results_with_classpath:
-        res_to_consider = results_with_classpath
-    elif all_results:
-        res_to_consider = all_results
-    else:
-        return None  
-
-    max_score = max(result['score'] for result in res_to_consider)
-    results_with_max_score = [result for result in res_to_consider if result['score'] == max_score]
-    
-    #if multiple results with maximum score, choose the one from OTT, NCBI or GBIF, in this order. If none of these, choose the first one
-    ott_source = [i for i,x in enumerate(results_with_max_score) if x['data_source_id'] == 179]
-    ncbi_source = [i for i,x in enumerate(results_with_max_score) if x['data_source_id'] == 4]
-    gbif_source = [i for i,x in enumerate(results_with_max_score) if x['data_source_id'] == 11]
-    
-    if ott_source:
-        chosen_result = results_with_max_score[ott_source[0]]
-    elif ncbi_source:
-        chosen_result = results_with_max_score[ncbi_source[0]]
-    elif gbif_source:
-        chosen_result = results_with_max_score[gbif_source[0]]
+    #if multiple results with maximum score, the one from OTT, NCBI or GBIF is chosen, in this order. If none of these, the first one
+    if best_filtered is not None:
+        return best_filtered[2]
+    elif best_all is not None:
+        return best_all[2]
     else:
-        chosen_result = results_with_max_score[0]
-        
-    return chosen_result
+        return None
+
+#Function to do fuzzy search in Global Names
+@timed('fuzzy_search_GN')
+def fuzzy_search_GN(full_name, taxfilter):
+    try:
+        return GN_prefetched[(full_name, taxfilter)]
+    except KeyError:
+        pass
+    
+    cached = cache_get('fuzzy_search_GN', full_name, taxfilter = taxfilter, source = name_source())
+    if cached is not cache_miss:
+        return cached
+    
+    #local names are searched without connecting to Global Names
+    if local_matcher is not None:
+        chosen_result = choose_GN_result(local_matcher.search(full_name), taxfilter)
+        cache_put('fuzzy_search_GN', full_name, chosen_result, taxfilter = taxfilter, source = name_source())
+        return chosen_result
+    
+    #start by fuzzy searching Global Names
+    try:
+        r = http_post('gn', 'gn_resolver', gn_api + '/name_resolvers.json',
+                      json = {'names':full_name, #searching for genus + species first to avoid homonyms 
+                              'best_match_only':'false'},
+                      max_tries = 10)
+    except ServiceUnavailable as err:
+        sys.stderr.write(str(err) + ' Skipping.\n')
+        return None
+    
+    chosen_result = choose_GN_result(r.json()['data'][0], taxfilter)
+    cache_put('fuzzy_search_GN', full_name, chosen_result, taxfilter = taxfilter, source = name_source())
+    return chosen_result        
+
+
+#Function to do fuzzy search of many names in Global Names, sending chunk_size names per request (separated by |)
+#The results for each name are chosen in the same way as fuzzy_search_GN() and cached for each name
+#Returns a dictionary keyed by name with the chosen result (None if not found)
+#Results are matched to names by the name supplied, and names missing from a response are searched individually
+#Names that could not be searched (for example, if the service is unavailable) are not included, and can be searched individually later
+@timed('fuzzy_search_GN_batch')
+def fuzzy_search_GN_batch(names, taxfilter, chunk_size = 200):
+    chosen_results = {}
+    to_search = []
+    for full_name in dict.fromkeys(names): #remove duplicates, keeping order
+        cached = cache_get('fuzzy_search_GN', full_name, taxfilter = taxfilter, source = name_source())
+        if cached is not cache_miss:
+            chosen_results[full_name] = cached
+        elif local_matcher is not None:
+            chosen_results[full_name] = fuzzy_search_GN(full_name, taxfilter)
+        elif '|' not in full_name:
+            to_search.append(full_name)
+    
+    for start in range(0, len(to_search), chunk_size):
+        chunk = to_search[start:start + chunk_size]
+        try:
+            r = http_post('gn', 'gn_resolver', gn_api + '/name_resolvers.json',
+                          json = {'names':'|'.join(chunk), 
+                                  'best_match_only':'false'},
+                          max_tries = 10)
+        except ServiceUnavailable as err:
+            sys.stderr.write(str(err) + ' Names will be searched individually.\n')
+            continue
         
+        data = {GN_data.get('supplied_name_string'):GN_data for GN_data in r.json()['data']}
+        missing = [full_name for full_name in chunk if full_name not in data]
+        if missing:
+            warnings.warn('Global Names did not return results for ' + str(len(missing)) + ' of ' + str(len(chunk)) + ' names, these will be searched individually.')
+        for full_name in chunk:
+            if full_name in data:
+                chosen_results[full_name] = choose_GN_result(data[full_name], taxfilter)
+                cache_put('fuzzy_search_GN', full_name, chosen_results[full_name], taxfilter = taxfilter, source = name_source())
+            else:
+                chosen_results[full_name] = fuzzy_search_GN(full_name, taxfilter)
+    return chosen_results
 
 
 # Function to fuzzy search names using Open Tree of Life API or global names resolver API
@@ -316,7 +1644,55 @@ def fuzzy_search_GN(full_name, taxfilter):
 # If found on global names, name is subject to exact search on a number of services, using functions listed in variable namesearch_functions (currently only OTT and GBIF)
 # UPDATE Apt 2019: dropping support for GBIF for now since pygbif does not work in python 3
 
+#Result of search_name(), with the same keys as the dictionary returned by search_name_uncached()
+#Slots use less memory than a dictionary for each name kept in memory, and it can be read as a dictionary (result['current_name'])
+class SearchResult:
+    __slots__ = ('matched_name', 'current_name', 'source_id', 'sp_ncbi_id', 'tax_source', 'tax_level', 'higher_taxonomy')
+
+    def __init__(self, **fields):
+        for key in self.__slots__:
+            setattr(self, key, fields.get(key))
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.__slots__)
+
+#Results of search_name() are also kept in memory,
+#and threads searching the same name at the same time share a single search
+search_name_results = BoundedMemo()
+search_name_flight = SingleFlight('search_name')
+
 def search_name(full_name, gnpath, context, taxfilter):
+    key = (full_name, gnpath, context, taxfilter, name_source())
+    try:
+        outdict = search_name_results[key]
+        metrics.count('memory_hits', 'search_name')
+        trace_branch('search_name memory')
+        return outdict
+    except KeyError:
+        pass
+    
+    outdict = search_name_flight.do(key, search_name_cached, full_name, gnpath, context, taxfilter)
+    if outdict is not None:
+        outdict = SearchResult(**outdict)
+    search_name_results[key] = outdict
+    return outdict
+
+def search_name_cached(full_name, gnpath, context, taxfilter):
+    cached = cache_get('search_name', full_name, context = context, taxfilter = taxfilter, source = name_source())
+    if cached is not cache_miss:
+        trace_branch('search_name cache')
+        return cached
+    
+    outdict = search_name_uncached(full_name, gnpath, context, taxfilter)
+    cache_put('search_name', full_name, outdict, context = context, taxfilter = taxfilter, source = name_source())
+    return outdict
+
+def search_name_uncached(full_name, gnpath, context, taxfilter):
     namesearch_functions = [lambda x: otl_checkname(x, context=context)]#, 
                             #lambda x: gbif_checkname(x, taxfilter=taxfilter)]
     
@@ -335,6 +1711,7 @@ def search_name(full_name, gnpath, context, taxfilter):
         
     #now check if chosen result has genus and species or only species
     if GN_search_result:
+        trace_branch('GN fuzzy')
         try:
             chosen_name = GNparser(GN_search_result['current_name_string'],gnpath)
         except:
@@ -346,6 +1723,7 @@ def search_name(full_name, gnpath, context, taxfilter):
     elif 'cs' in GNparser(full_name,gnpath).keys:
         GN_search_result = fuzzy_search_GN(GNparser(full_name,gnpath)['cg'], taxfilter = taxfilter)
         if GN_search_result:
+            trace_branch('GN fuzzy genus')
             try:
                 chosen_name = GNparser(GN_search_result['current_name_string'],gnpath)
             except:
@@ -354,9 +1732,11 @@ def search_name(full_name, gnpath, context, taxfilter):
             genus_to_search = chosen_name['cg']
         #if still no result, we consider we can't find it
         else:
+            trace_branch('not found')
             return None
     #if no result and there was no species information, so it was already a genus search
     else:
+        trace_branch('not found')
         return None
         
 
@@ -371,9 +1751,8 @@ def search_name(full_name, gnpath, context, taxfilter):
         else:
             full_name_to_search  = chosen_name['cg']
             
-        r = otl_tnrs(full_name_to_search, do_approximate = False, context = context)
-        if r.json()['results']:
-            results = r.json()['results'][0]['matches']
+        results = otl_exact_match(full_name_to_search, context)
+        if results:
             scores = [results[i]['score'] for i in range(len(results))] #make a list with matches' scores
             best = scores.index(max(scores)) #returns index for result with highest score. If more than one, keeps first
             
@@ -381,16 +1760,14 @@ def search_name(full_name, gnpath, context, taxfilter):
             
             if outdict['tax_level'] in ['species','subspecies']:
                 ott_id = results[best]['taxon']['ott_id']
-                try:
-                    ncbi_id = list2dict(results[best]['taxon']['tax_sources'])['ncbi']
-                except KeyError:
-                    ncbi_id = None       
+                ncbi_id = taxon_ncbi_id(results[best]['taxon'])
                 outdict['matched_name'] =  GN_search_result['canonical_form']
                 outdict['current_name'] =  results[best]['taxon']['name']
                 outdict['source_id'] = ott_id
                 outdict['sp_ncbi_id'] = ncbi_id
                 outdict['tax_source'] = 'OTT'
                 outdict['higher_taxonomy'] = taxonomy_OTT(ott_id)
+                trace_branch('OTT species')
                 return outdict
             #if match in OTT is not a species, try searching for genus
             else:
@@ -400,14 +1777,14 @@ def search_name(full_name, gnpath, context, taxfilter):
         else:
             genus_to_search = chosen_name['cg']
             search_for_genus = True
+        trace_branch('OTT species not found')
         
             
     
     if search_for_genus:
         #start by searching for genus or higher names found in GN in OTL without fuzzy matching
-        r = otl_tnrs(genus_to_search, do_approximate = False, context = context)
-        if r.json()['results']: #if results found, return the best
-            results = r.json()['results'][0]['matches']
+        results = otl_genus_match(genus_to_search, context)
+        if results: #if results found, return the best
             scores = [results[i]['score'] for i in range(len(results))] #make a list with matches' scores
             best = scores.index(max(scores)) #returns index for result with highest score. If more than one, keeps first
             
@@ -417,8 +1794,9 @@ def search_name(full_name, gnpath, context, taxfilter):
             outdict['source_id'] = results[best]['taxon']['ott_id']
             outdict['tax_source'] = 'OTT'
             outdict['higher_taxonomy'] = taxonomy_OTT(results[best]['taxon']['ott_id'])
-            
+            trace_branch('OTT genus')
             return outdict
+        trace_branch('OTT genus not found')
 
                 
     #now that a name was found in global names or OTT, try exact matches in our taxonomic sources (currently, OTT only)
@@ -437,6 +1815,7 @@ def search_name(full_name, gnpath, context, taxfilter):
             if r['level'] == 'species' and 'ncbi_id' in list(r.keys()):
                 outdict['sp_ncbi_id'] = r['ncbi_id']
             
+            trace_branch('namesearch ' + r['name_source'])
             break
 
                     
@@ -446,7 +1825,7 @@ def search_name(full_name, gnpath, context, taxfilter):
         outdict['current_name'] =  GN_search_result['canonical_form']
         outdict['tax_source'] = 'GN_datasourceid_' + str(GN_search_result['data_source_id']) 
         outdict['source_id'] = str(GN_search_result['data_source_id'])
-        
+        trace_branch('GN only')
         
         GNparsed = parse_GN_classpath(GN_search_result)
         outdict['tax_level'] = GNparsed['tax_level']
@@ -458,15 +1837,541 @@ def search_name(full_name, gnpath, context, taxfilter):
 
 
 
+#This function collects the exact-match queries that search_name() and the genus fallback will make
+#for a list of names, and sends them to otl tnrs in batches instead of one name per request
+#Global Names is also searched in batches, and results obtained here are kept so that they are not searched again
+def prefetch_names(names, gnpath, context, taxfilter, chunk_size = 500, gn_chunk_size = 200):
+    if len(GN_prefetched) + len(otl_prefetched) > prefetch_limit:
+        GN_prefetched.clear()
+        otl_prefetched.clear()
+    
+    #names already resolved earlier in this process or in a previous run do not need to be searched again
+    names = [full_name for full_name in names 
+             if (full_name, gnpath, context, taxfilter, name_source()) not in search_name_results
+             and cache_get('search_name', full_name, context = context, taxfilter = taxfilter, source = name_source()) is cache_miss]
+    
+    #Global Names is searched for all names together, except those prefetched for a previous window
+    to_search = [full_name for full_name in names if (full_name, taxfilter) not in GN_prefetched]
+    for full_name, GN_search_result in fuzzy_search_GN_batch(to_search, taxfilter, chunk_size = gn_chunk_size).items():
+        GN_prefetched[(full_name, taxfilter)] = GN_search_result
+    
+    pending = []
+    for full_name in names:
+        try:
+            GN_search_result = fuzzy_search_GN(full_name, taxfilter = taxfilter)
+        except (ValueError, TypeError):
+            continue
+        GN_prefetched[(full_name, taxfilter)] = GN_search_result
+        if not GN_search_result:
+            continue
+        
+        try:
+            chosen_name = GNparser(GN_search_result['current_name_string'],gnpath)
+        except:
+            try:
+                chosen_name = GNparser(GN_search_result['canonical_form'],gnpath)
+            except:
+                continue
+        
+        #same names that search_name() and the genus fallback in the main loop search for
+        pending.append(' '.join([chosen_name[key] for key in ['cg','cs','csub'] if key in chosen_name]))
+        if 'cg' in chosen_name:
+            pending.append(chosen_name['cg'])
+        pending.append(GN_search_result['canonical_form'])
+        
+    pending = [query for query in pending if (query, context) not in otl_prefetched]
+    for query, matches in otl_tnrs_batch(pending, context = context, chunk_size = chunk_size).items():
+        otl_prefetched[(query, context)] = matches
+        
+
 #This function returns a fuzzy matching score between the searched name and the corrected name.
 #Since we are using different sources for taxonomy (open tree of life and global names), scores are not comparable
 #If in the future global names includes OTT as a source of data, we might be able to rewrite the search_names() function and deprecate this one
 def fuzzy_score(name1,name2):
     return fuzz.ratio(name1, name2)
 
-#read input and run program
-# for each record in the input file, it will try to find a name
-# the folling keys will be added to the record, saved in a new file named corrected_new_lines.txt
+#rapidfuzz is optional, and used by fuzzy_scores() to compute many scores at once
+try:
+    import rapidfuzz.process, rapidfuzz.distance
+except ImportError:
+    rapidfuzz = None
+
+#When fuzzywuzzy uses python-Levenshtein (as in the docker image), fuzz.ratio() is computed from the Indel distance,
+#so scores computed in bulk with rapidfuzz are the same. Otherwise, fuzz.ratio() uses difflib and is called for each pair
+bulk_scoring = (rapidfuzz is not None and 
+                hasattr(rapidfuzz.process, 'cpdist') and 
+                fuzz.SequenceMatcher.__module__ != 'difflib')
+
+#This function returns the same scores as fuzzy_score() for a list of (name1, name2) pairs
+@timed('fuzzy_scores')
+def fuzzy_scores(pairs):
+    if not bulk_scoring:
+        return [fuzzy_score(name1, name2) for name1, name2 in pairs]
+    
+    #special cases handled by fuzzywuzzy before comparing strings
+    scores = [None] * len(pairs)
+    to_score = []
+    for i, (name1, name2) in enumerate(pairs):
+        if name1 is None or name2 is None:
+            scores[i] = 0
+        elif name1 == name2:
+            scores[i] = 100
+        elif not name1 or not name2:
+            scores[i] = 0
+        else:
+            to_score.append(i)
+    
+    if to_score:
+        distances = rapidfuzz.process.cpdist([pairs[i][0] for i in to_score], 
+                                             [pairs[i][1] for i in to_score], 
+                                             scorer = rapidfuzz.distance.Indel.distance, 
+                                             workers = -1)
+        for i, distance in zip(to_score, distances):
+            lensum = len(pairs[i][0]) + len(pairs[i][1])
+            scores[i] = int(round(100 * ((lensum - int(distance)) / lensum)))
+    return scores
+
+#name compared to the matched name to compute tax_score: name, followed by species if in a separate column
+def score_query(record):
+    try:
+        return record['name'] + ' ' + record['s']
+    except KeyError:
+        return record['name']
+
+#computes tax_score for many records at once, for records in which a name was matched
+def score_records(records):
+    records = [record for record in records if 'tax_matched' in record]
+    scores = fuzzy_scores([(score_query(record), record['tax_matched']) for record in records])
+    for record, score in zip(records, scores):
+        record['tax_score'] = score
+
+#############################################
+#Output tables
+#Records are written to csv as soon as they are processed, with a fixed set of columns
+#so that nothing needs to be kept in memory until the end of the run
+
+#higher taxonomic ranks, in the order they are written to the output
+#these are the ranks used in Open Tree Taxonomy, from highest to lowest. Lineages also include taxa with 'no rank',
+#which are not written, and species (written as cs). Other ranks (for example, from Global Names) are ignored
+taxonomic_ranks = ['tax_' + rank for rank in ['domain',
+                   'superkingdom',
+                   'kingdom',
+                   'subkingdom',
+                   'division',
+                   'infrakingdom',
+                   'superphylum',
+                   'phylum',
+                   'subphylum',
+                   'subdivision',
+                   'infraphylum',
+                   'superclass',
+                   'class',
+                   'subclass',
+                   'infraclass',
+                   'subterclass',
+                   'cohort',
+                   'subcohort',
+                   'superorder',
+                   'order',
+                   'suborder',
+                   'infraorder',
+                   'parvorder',
+                   'superfamily',
+                   'family',
+                   'subfamily',
+                   'supertribe',
+                   'tribe',
+                   'subtribe',
+                   'genus',
+                   'subgenus',
+                   'section',
+                   'subsection',
+                   'series',
+                   'subseries',
+                   'species group',
+                   'species subgroup',
+                   'infraspecificname',
+                   'subspecies',
+                   'natio',
+                   'variety',
+                   'varietas',
+                   'subvariety',
+                   'forma',
+                   'subform']]
+
+first_cols = ('name',
+                    'tax_updated_fullname',
+                    'tax_taxonomy_source',
+                    'rank',
+                    'tax_matched',
+                    'tax_score',
+                    'tax_ott_id',
+                    'tax_ncbi_id',
+                    'tax_name_source',
+                    'tax_matched_id_in_source',
+                    'cg',
+                    'tax_cg_ott_id',
+                    'tax_cg_ncbi_id',
+                    'cs',
+                    'tax_cs_ott_id',
+                    'tax_cs_ncbi_id',
+                    'csub',
+                    'tax_ott_accepted_name',
+                    'tax_ott_version',
+                    'tax_context',
+                    'tax_filter',
+                    'tax_higher_source')
+
+#columns of the table of matched names
+def matched_columns(other_cols):
+    return list(dict.fromkeys(list(first_cols) + taxonomic_ranks + list(other_cols)))
+
+#columns of the table of unmatched names
+def unmatched_columns(other_cols):
+    return list(dict.fromkeys(list(first_cols) + list(other_cols) + ['problem'] + taxonomic_ranks))
+
+#name of a column in the output
+def output_column(col):
+    col = col.replace('tax_','')
+    col = col.replace('rank','rank_matched')
+    col = col.replace('csub','updated_subspecies')
+    col = col.replace('cg','updated_genus')
+    col = col.replace('cs','updated_species')
+    return col
+
+#missing values are written as empty cells
+def output_value(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    return value
+
+#Writes records to a csv table, one row at a time
+#The first column is the position of the record in the input table
+class TableWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline = '')
+        self.writer = csv.writer(self.file)
+        self.columns = columns
+        self.ignored = set()
+        self.writer.writerow([''] + [output_column(col) for col in columns])
+
+    @timed('output')
+    def write(self, index, record):
+        for key in record.keys():
+            if key not in self.ignored and key not in self.columns:
+                warnings.warn('Column ' + key + ' is not part of the output and will be ignored.')
+                self.ignored.add(key)
+        self.writer.writerow([index] + [output_value(record.get(col)) for col in self.columns])
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+#Parquet output (--output-format parquet) needs pyarrow, which is optional
+try:
+    import pyarrow, pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+#ids in Open Tree Taxonomy and NCBI, written as integers in parquet output
+id_columns = ['tax_ott_id', 'tax_ncbi_id', 'tax_cg_ott_id', 'tax_cg_ncbi_id', 'tax_cs_ott_id', 'tax_cs_ncbi_id']
+#columns with few distinct values, dictionary-encoded in parquet output
+category_columns = list(taxonomic_ranks) + ['rank', 'tax_taxonomy_source', 'tax_name_source', 
+                                             'tax_higher_source', 'tax_ott_version', 'tax_context', 'tax_filter', 'problem']
+
+#Writes matched and unmatched records to a single parquet file, with a column 'status' (matched or unmatched)
+#Columns are the same as in the csv tables, and 'index' is the position of the record in the input table
+#Ids and scores are integers, columns with few distinct values (ranks, sources) are dictionary-encoded and other columns are strings
+#Records are written in row groups of row_group_size records
+class ParquetWriter:
+    def __init__(self, path, other_cols, row_group_size = 10000):
+        if pyarrow is None:
+            raise Exception('Parquet output requires the python library pyarrow.')
+        self.columns = matched_columns(other_cols) + ['problem']
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.ignored = set()
+        
+        fields = [pyarrow.field('index', pyarrow.int64()), 
+                  pyarrow.field('status', pyarrow.dictionary(pyarrow.int32(), pyarrow.string()))]
+        fields += [pyarrow.field(output_column(col), self.column_type(col)) for col in self.columns]
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    @staticmethod
+    def column_type(col):
+        if col in id_columns or col == 'tax_score':
+            return pyarrow.int64()
+        elif col in category_columns:
+            return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        else:
+            return pyarrow.string()
+
+    @staticmethod
+    def column_value(col, value):
+        if value is None or (isinstance(value, float) and value != value):
+            return None
+        if col in id_columns or col == 'tax_score':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+        return str(value)
+
+    @timed('output')
+    def write(self, index, record):
+        for key in record.keys():
+            if key not in self.ignored and key not in self.columns:
+                warnings.warn('Column ' + key + ' is not part of the output and will be ignored.')
+                self.ignored.add(key)
+        self.rows.append((index, record))
+        if len(self.rows) >= self.row_group_size:
+            self.write_row_group()
+
+    @timed('output')
+    def flush(self):
+        self.write_row_group()
+
+    #not timed by itself, since it is called from write() and flush(), which are
+    def write_row_group(self):
+        if not self.rows:
+            return
+        arrays = [pyarrow.array([index for index, record in self.rows], pyarrow.int64()),
+                  pyarrow.array(['unmatched' if record.get('problem') else 'matched' for index, record in self.rows]).dictionary_encode()]
+        for col, field in zip(self.columns, list(self.schema)[2:]):
+            values = [self.column_value(col, record.get(col)) for index, record in self.rows]
+            if col in category_columns:
+                arrays.append(pyarrow.array(values, pyarrow.string()).dictionary_encode())
+            else:
+                arrays.append(pyarrow.array(values, field.type))
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema = self.schema))
+        self.rows = []
+
+    #matched and unmatched records are written by the same writer, so it can be closed twice
+    def close(self):
+        if self.writer is not None:
+            self.flush()
+            self.writer.close()
+            self.writer = None
+
+#yields (path, header, rows) for each output file of a previous run with this prefix, csv tables or parquet
+#rows are dictionaries keyed by output column, with values as text and empty cells as ''
+def previous_outputs(prefix):
+    for suffix in ['_matched.csv', '_unmatched.csv']:
+        if os.path.isfile(prefix + suffix):
+            with open(prefix + suffix, newline = '') as infile:
+                reader = csv.reader(infile)
+                header = next(reader)
+                yield prefix + suffix, header, (dict(zip(header, row)) for row in reader)
+    if os.path.isfile(prefix + '.parquet'):
+        if pyarrow is None:
+            raise Exception('Reading previous output in parquet requires the python library pyarrow.')
+        parquet = pyarrow.parquet.ParquetFile(prefix + '.parquet')
+        header = parquet.schema_arrow.names
+        def rows():
+            for batch in parquet.iter_batches():
+                for row in batch.to_pylist():
+                    yield {col:('' if value is None else str(value)) for col, value in row.items()}
+        yield prefix + '.parquet', header, rows()
+
+#Loads the information found for each name in the output of a previous run (--previous), to be copied instead of searched again
+#Only rows searched with the same context, filter and version of Open Tree Taxonomy are used
+#Rows are keyed in the same way as in the run (see record_key), so with ncbi_column rows found by ncbi id are reused for the same id
+#Returns a ResolvedNames with the same fields as resolution_fields() for each name
+def load_previous(prefix, context, taxfilter, ott_version, ncbi_column = None):
+    columns = {output_column(col):col for col in first_cols + tuple(taxonomic_ranks) + ('problem',)}
+    previous = ResolvedNames()
+    n_stale = 0
+    n_files = 0
+    for path, header, rows in previous_outputs(prefix):
+        if 'context' not in header or 'filter' not in header:
+            warnings.warn('Previous output ' + path + ' does not record context and filter, it will not be used.')
+            continue
+        n_files += 1
+        for row in rows:
+            if row['ott_version'] != ott_version:
+                n_stale += 1
+                continue
+            if row['context'] != context or row['filter'] != (taxfilter or ''):
+                continue
+            record = {columns[col]:value for col, value in row.items() if col in columns and value != ''}
+            record['name'] = row['name']
+            if ncbi_column is not None:
+                record[ncbi_column] = row.get(output_column(ncbi_column))
+            #rows with an ncbi id that were searched by name in the previous run are searched again
+            if record_ncbi_id(record, ncbi_column) is not None and record.get('tax_name_source', 'NCBI') != 'NCBI':
+                continue
+            previous[record_key(record, ncbi_column)] = resolution_fields(record)
+    if not n_files:
+        raise Exception('No usable output of a previous run found with prefix ' + prefix + 
+                        ' (' + prefix + '_matched.csv, ' + prefix + '_unmatched.csv or ' + prefix + '.parquet).')
+    sys.stderr.write(str(len(previous)) + ' names loaded from previous output, ' + 
+                     str(n_stale) + ' rows from other versions of Open Tree Taxonomy will be searched again.\n')
+    return previous
+
+#Journal of processed records, used to resume a run that was interrupted
+#The first line records the settings of the run, and each following line a record written to the output, as json
+#Lines are flushed as soon as they are written and synced to disk every sync_every records
+class Checkpoint:
+    def __init__(self, path, settings, sync_every = 100):
+        self.path = path
+        self.settings = settings
+        self.sync_every = sync_every
+        self.file = None
+        self.n_written = 0
+        self.n_finished = 0
+
+    #checks that the journal is from a run with the same settings
+    #returns the number of records already processed, which are always the first records in the input
+    def load(self):
+        if not os.path.isfile(self.path):
+            warnings.warn('No checkpoint found in ' + self.path + ', starting from the first record.')
+            return 0
+
+        with open(self.path) as infile:
+            try:
+                settings = json.loads(next(infile))
+            except (StopIteration, ValueError):
+                return 0
+            for key in ['input', 'context', 'tax_filter', 'shard', 'ncbi_column']:
+                if settings.get(key) != self.settings.get(key):
+                    raise Exception('Cannot resume: ' + key + ' is different from the interrupted run (' + str(settings.get(key)) + ').')
+            if settings.get('ott_version') != self.settings.get('ott_version'):
+                warnings.warn('Open Tree Taxonomy changed from ' + str(settings.get('ott_version')) + ' to ' +
+                              str(self.settings.get('ott_version')) + ' since the interrupted run.')
+        self.n_finished = sum(1 for entry in self.entries())
+        return self.n_finished
+
+    #yields the records in the journal in the order they were processed, as (index, problem, record)
+    def entries(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path) as infile:
+            next(infile, None) #settings
+            for line in infile:
+                try:
+                    entry = json.loads(line)
+                except ValueError: #last line might be incomplete if the run was killed while writing
+                    break
+                yield entry['index'], entry['problem'], entry['record']
+
+    #starts a new journal, or adds to the existing one when resuming
+    #an incomplete last line is removed before adding to the journal
+    def open(self, resume = False):
+        if resume and self.n_finished:
+            with open(self.path, 'rb+') as infile:
+                lines = 0
+                for line in infile:
+                    lines += 1
+                    if lines == self.n_finished + 1:
+                        infile.truncate(infile.tell())
+                        break
+            self.file = open(self.path, 'a')
+        else:
+            self.file = open(self.path, 'w')
+            self.file.write(json.dumps(self.settings) + '\n')
+            self.file.flush()
+
+    def add(self, index, problem, record):
+        self.file.write(json.dumps({'index':index, 'problem':problem, 'record':record}, default = str) + '\n')
+        self.file.flush()
+        self.n_written += 1
+        if self.n_written % self.sync_every == 0:
+            os.fsync(self.file.fileno())
+
+    #the journal is removed when the run finishes
+    def close(self, remove = True):
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+#############################################
+#Sharded execution: with --shard K/N, only records in shard K of N are searched, so that shards can run
+#as independent workers (for example, in different computers) on the same input
+#Records are assigned to shards by a hash of the normalized name, so that duplicates are in the same shard
+#Each shard writes its own output tables (see shard_prefix), keeping the position of records in the input,
+#and --merge N combines the output of all shards in the same tables as a single run, in the original order
+
+#parses shards given as K/N, with K from 1 to N
+def parse_shard(text):
+    try:
+        k, n = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shards must be given as K/N')
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError('shard K must be between 1 and N')
+    return k, n
+
+#prefix of output files of a shard
+def shard_prefix(prefix, k, n):
+    return prefix + '.shard' + str(k) + '-of-' + str(n)
+
+#returns the shard of a name, from 1 to n. The hash does not change between runs or computers
+def name_shard(name, n):
+    normalized = ' '.join(str(name).split()).capitalize()
+    return zlib.crc32(normalized.encode('utf-8')) % n + 1
+
+#merges the output tables of n shards into prefix_matched.csv and prefix_unmatched.csv, ordered by position in the input
+#all shards must have finished and used the same version of Open Tree Taxonomy
+def merge_shards(prefix, n):
+    for k in range(1, n + 1):
+        if os.path.isfile(shard_prefix(prefix, k, n) + '.checkpoint.jsonl'):
+            raise Exception('Shard ' + str(k) + ' of ' + str(n) + ' did not finish, resume it before merging.')
+    if all(os.path.isfile(shard_prefix(prefix, k, n) + '.parquet') for k in range(1, n + 1)):
+        return merge_parquet_shards(prefix, n)
+    
+    versions = set()
+    for suffix in ['_matched.csv', '_unmatched.csv']:
+        paths = [shard_prefix(prefix, k, n) + suffix for k in range(1, n + 1)]
+        missing = [path for path in paths if not os.path.isfile(path)]
+        if missing:
+            raise Exception('Output of shards not found: ' + ', '.join(missing))
+        
+        infiles = [open(path, newline = '') for path in paths]
+        readers = [csv.reader(infile) for infile in infiles]
+        headers = [next(reader) for reader in readers]
+        if any(header != headers[0] for header in headers):
+            raise Exception('Shards have different columns, they must be run on the same input.')
+        version_col = headers[0].index('ott_version')
+        
+        with open(prefix + suffix + '.tmp', 'w', newline = '') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(headers[0])
+            for row in heapq.merge(*readers, key = lambda row: int(row[0])):
+                versions.add(row[version_col])
+                writer.writerow(row)
+        for infile in infiles:
+            infile.close()
+    
+    versions.discard('')
+    if len(versions) > 1:
+        for suffix in ['_matched.csv', '_unmatched.csv']:
+            os.remove(prefix + suffix + '.tmp')
+        raise Exception('Shards used different versions of Open Tree Taxonomy (' + ', '.join(sorted(versions)) + 
+                        '), run them again with --ott-version.')
+    for suffix in ['_matched.csv', '_unmatched.csv']:
+        os.replace(prefix + suffix + '.tmp', prefix + suffix)
+    sys.stderr.write('Merged ' + str(n) + ' shards in ' + prefix + '_matched.csv and ' + prefix + '_unmatched.csv\n')
+
+#merges parquet output of n shards into prefix.parquet, ordered by position in the input
+def merge_parquet_shards(prefix, n):
+    if pyarrow is None:
+        raise Exception('Merging parquet output requires the python library pyarrow.')
+    tables = [pyarrow.parquet.read_table(shard_prefix(prefix, k, n) + '.parquet') for k in range(1, n + 1)]
+    if any(table.schema != tables[0].schema for table in tables):
+        raise Exception('Shards have different columns, they must be run on the same input.')
+    table = pyarrow.concat_tables(tables).unify_dictionaries().sort_by('index')
+    versions = set(table.column('ott_version').drop_null().unique().to_pylist())
+    if len(versions) > 1:
+        raise Exception('Shards used different versions of Open Tree Taxonomy (' + ', '.join(sorted(versions)) + 
+                        '), run them again with --ott-version.')
+    pyarrow.parquet.write_table(table, prefix + '.parquet')
+    sys.stderr.write('Merged ' + str(n) + ' shards in ' + prefix + '.parquet\n')
+
+#This function searches the name of a single record and adds the information found to the record
+# the folling keys will be added to the record
 # cg: corrected genus name (senior synonym if available)
 # cs: corrected species name (senior synonym if available)
 # csub: corrected subspecific names (senior synonym if available)
@@ -475,242 +2380,744 @@ def fuzzy_score(name1,name2):
 # tax_source: OTT (open tree of life) or GN (global names)
 # tax_[taxonomic rank]: several optional keys containing higher taxonomic levels for the
 # problem: reason why record was rejected
+# Returns the problem ('no_name', 'no_taxonomy' or 'no_species'), or None if the record is OK
+# If score is False, tax_score is not computed
+@traced_record
+def resolve_record(record, gnpath, context, taxfilter, ott_version, genus_search = False, score = True):
+    #first, record version of open tree taxonomy used here, and the context and filter of the search
+    record['tax_ott_version'] = ott_version
+    record['tax_context'] = context
+    record['tax_filter'] = taxfilter
+    
+    #records without a name (empty or missing) are not searched
+    if not isinstance(record['name'], str) or not record['name'].strip():
+        record.update({'problem':'no_name'})
+        trace_branch('no name given')
+        return 'no_name'
+    
+    try:
+        searchname_response =  search_name(record['name'].capitalize(), gnpath, context = context, taxfilter = taxfilter)
+    except (ValueError, TypeError) as err:
+        searchname_response = None
+        trace_branch('search failed (' + type(err).__name__ + ')')
+    
+    #if nothing was found, add to problems with flag no_name               
+    if not searchname_response:
+        record.update({'problem':'no_name'})
+        return 'no_name'
+    
+    #if something was found, parse matched name to genus and species and add information to output database
+    else:
+        record.update(GNparser(searchname_response['current_name'], gnpath)) #this parses name found, separating genus and species
+        record.update({'tax_updated_fullname':searchname_response['current_name']})
+        record.update({'tax_name_source':searchname_response['tax_source']})
+        record.update({'tax_matched':searchname_response['matched_name']})
+        record['tax_matched_id_in_source'] = searchname_response['source_id']
+        if searchname_response['tax_source'] == 'OTT':
+           if searchname_response['tax_level'] == 'species':
+               record['tax_cs_ott_id'] = searchname_response['source_id']
+           elif searchname_response['tax_level'] == 'genus':
+               record['tax_cg_ott_id'] = searchname_response['source_id']
+        if searchname_response['sp_ncbi_id']:
+            record['tax_cs_ncbi_id'] = searchname_response['sp_ncbi_id']
+        
+        #when searching many records, scores can be computed later for all of them with score_records()
+        if score:
+            record.update({'tax_score':fuzzy_score(score_query(record), record['tax_matched'])})
+        
 
-if __name__ == "__main__":
+    #if name was found, but not in OTT, try obtaining higher taxonomy from genus name in ott first
+    #if can't be found in OTT, use the taxonomy from the name source
+    #if no taxonomy from name source, output as a problem
+    if searchname_response['tax_source'] != 'OTT':
+        ott_genus_search = otl_checkname(record['cg'], context = context)
+        if ott_genus_search and ott_genus_search['level'] == 'genus' and ott_genus_search['higher_taxonomy']:
+            record.update(ott_genus_search['higher_taxonomy'])
+            record['tax_taxonomy_source'] = 'OTT'
+            trace_branch('OTT genus taxonomy')
+            
+        elif searchname_response['higher_taxonomy'] is None:
+            record.update({'problem':'no_taxonomy'})
+            trace_branch('no taxonomy')
+            return 'no_taxonomy'
+            
+        else:
+            record.update(searchname_response['higher_taxonomy'])
+            record['tax_taxonomy_source'] = searchname_response['tax_source']
+            trace_branch('source taxonomy')
+
+    #if tax_source is OTT, just record higher taxonomy        
+    else:
+        record['tax_taxonomy_source'] = 'OTT'
+        record.update(searchname_response['higher_taxonomy'])
+        
+
+    #finally, if record had a species read from OCR but only genus found, output to problems            
+    if 's' in list(record.keys()) and 'cs' not in list(record.keys()) and not genus_search:
+        record.update({'problem':'no_species'})
+        return 'no_species'
+    
+    return None
+
+#This function finds a record by its ncbi id instead of searching its name, and adds the same keys as resolve_record()
+#The ott taxon with this id is found in the crosswalk of the local taxonomy (see OTTIndex), or with the api if not using one
+#Context and filter are not used, since the id already identifies the taxon
+#Returns the problem ('no_name' if the id is not in Open Tree Taxonomy), or None if the record is OK
+@traced_record
+def resolve_ncbi_record(record, ncbi_id, gnpath, context, taxfilter, ott_version):
+    record['tax_ott_version'] = ott_version
+    record['tax_context'] = context
+    record['tax_filter'] = taxfilter
+    
+    taxon = otl_taxon(ncbi_id, ncbi = True)
+    if not taxon:
+        record.update({'problem':'no_name'})
+        trace_branch('NCBI id not found')
+        return 'no_name'
+    trace_branch('NCBI id')
+    
+    record.update(GNparser(taxon['name'], gnpath))
+    record['tax_updated_fullname'] = taxon['name']
+    record['tax_name_source'] = 'NCBI'
+    record['tax_matched'] = taxon['name']
+    record['tax_matched_id_in_source'] = ncbi_id
+    if taxon['rank'] == 'species':
+        record['tax_cs_ott_id'] = taxon['ott_id']
+        record['tax_cs_ncbi_id'] = ncbi_id
+    elif taxon['rank'] == 'genus':
+        record['tax_cg_ott_id'] = taxon['ott_id']
+        record['tax_cg_ncbi_id'] = ncbi_id
+    record['tax_taxonomy_source'] = 'OTT'
+    record.update(taxonomy_OTT(taxon['ott_id']))
+    return None
+
+#returns the ncbi id in a value from the input (for example 9606, 9606.0 or ncbi:9606) as a string, or None if empty or not an id
+def parse_ncbi_id(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    text = str(value).strip()
+    if text.lower().startswith('ncbi:'):
+        text = text[5:]
+    if text.endswith('.0'):
+        text = text[:-2]
+    if not text.isdigit() or int(text) == 0:
+        return None
+    return str(int(text))
+
+#returns the ncbi id of a record in ncbi_column, or None if it has none and should be found by name
+def record_ncbi_id(record, ncbi_column = None):
+    if ncbi_column is None:
+        return None
+    return parse_ncbi_id(record.get(ncbi_column))
+
+#returns the key under which the information found for a record is kept in resolved (see resolve_names):
+#ncbi:<id> for records found by ncbi id in ncbi_column, or the name otherwise
+def record_key(record, ncbi_column = None):
+    ncbi_id = record_ncbi_id(record, ncbi_column)
+    if ncbi_id is not None:
+        return 'ncbi:' + ncbi_id
+    return record['name']
+
+#This function returns the information found for a record, to be copied to other records with the same name
+def resolution_fields(record):
+    fields = {}
+    for k, v in record.items():
+        if 'tax_' in k or k in ['rank', 'csub', 'cg', 'cs']:
+            fields[k] = v
+            
+        if 'problem' in k:
+            fields[k] = v
+    return fields
+
+#Compact store of the information found for each name (see resolution_fields), used instead of a dictionary of dictionaries
+#Fields are kept in columns, with one position per name:
+# - fields with few distinct values (ranks, higher taxa, sources, status) as arrays of codes into a table of distinct values,
+#   where code 0 is a missing field and -1 is nan
+# - ids and scores as arrays of 64-bit integers. A column is changed to a list if it gets a value that is not an id
+# - other fields (for example, matched names) as lists
+#Can be used as a dictionary keyed by name: names[name] = fields, names[name] returns a new dictionary of fields
+class ResolvedNames:
+    coded_fields = set(category_columns) | {'cg'}
+    integer_fields = set(id_columns) | {'tax_score'}
+    #values marking a missing field and nan in integer columns
+    missing_integer = -2 ** 63
+    nan_integer = -2 ** 63 + 1
+    #value marking a missing field in list columns
+    missing = object()
+
+    def __init__(self):
+        self.rows = {}
+        self.columns = {}
+        self.kinds = {} #'coded', 'list', or the type of ids (int or str) for integer columns
+        self.codes = {}
+        self.values = [None]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def keys(self):
+        return self.rows.keys()
+
+    #position of a name in the store, in the order names were added
+    def index(self, name):
+        return self.rows[name]
+
+    def add_column(self, field, value):
+        n = len(self.rows)
+        if field in self.coded_fields:
+            self.kinds[field] = 'coded'
+            self.columns[field] = array.array('i', [0]) * n
+        elif field in self.integer_fields and self.integer(value, type(value)) is not None:
+            self.kinds[field] = type(value)
+            self.columns[field] = array.array('q', [self.missing_integer]) * n
+        else:
+            self.kinds[field] = 'list'
+            self.columns[field] = [self.missing] * n
+
+    #returns a value of an integer column as an integer, or None if it cannot be stored in that column
+    def integer(self, value, kind):
+        if isinstance(value, float) and value != value:
+            return self.nan_integer
+        if kind is int and type(value) is int and abs(value) < 2 ** 62:
+            return value
+        if kind is str and isinstance(value, str) and value.isdigit() and len(value) < 19 and str(int(value)) == value:
+            return int(value)
+        return None
+
+    def encode(self, value):
+        if isinstance(value, float) and value != value:
+            return -1
+        key = (type(value), value) #so that 1, 1.0 and True are different values
+        try:
+            return self.codes[key]
+        except KeyError:
+            self.values.append(value)
+            code = self.codes[key] = len(self.values) - 1
+            return code
+
+    def clear(self, field, row):
+        kind = self.kinds[field]
+        if kind == 'coded':
+            self.columns[field][row] = 0
+        elif kind == 'list':
+            self.columns[field][row] = self.missing
+        else:
+            self.columns[field][row] = self.missing_integer
+
+    def set(self, field, row, value):
+        if field not in self.columns:
+            self.add_column(field, value)
+        kind = self.kinds[field]
+        if kind == 'coded':
+            self.columns[field][row] = self.encode(value)
+            return
+        if kind != 'list':
+            number = self.integer(value, kind)
+            if number is not None:
+                self.columns[field][row] = number
+                return
+            #not an id, so this column is kept as a list from now on
+            self.columns[field] = [self.get(field, i) for i in range(len(self.rows))]
+            self.kinds[field] = 'list'
+        self.columns[field][row] = value
+
+    #returns the value of a field for a row, or missing
+    def get(self, field, row):
+        kind = self.kinds[field]
+        value = self.columns[field][row]
+        if kind == 'coded':
+            if value == 0:
+                return self.missing
+            return nan if value == -1 else self.values[value]
+        if kind == 'list':
+            return value
+        if value == self.missing_integer:
+            return self.missing
+        if value == self.nan_integer:
+            return nan
+        return kind(value)
+
+    def __setitem__(self, name, fields):
+        row = self.rows.get(name)
+        if row is None:
+            row = self.rows[name] = len(self.rows)
+            for field, column in self.columns.items():
+                column.append(0 if self.kinds[field] == 'coded' else 
+                              self.missing if self.kinds[field] == 'list' else self.missing_integer)
+        else:
+            for field in self.columns:
+                self.clear(field, row)
+        #the same name is often in several fields (for example, matched, current and accepted name), and is kept only once
+        strings = {}
+        for field, value in fields.items():
+            if isinstance(value, str):
+                value = strings.setdefault(value, value)
+            self.set(field, row, value)
+
+    def __getitem__(self, name):
+        row = self.rows[name]
+        fields = {}
+        for field in self.columns:
+            value = self.get(field, row)
+            if value is not self.missing:
+                fields[field] = value
+        return fields
+
+#############################################
+#Library interface
+#resolve_names() can be used to search names from other python programs, without going through files:
+#
+#   import TaxReformer
+#   for record in TaxReformer.resolve_names(['Apis mellifera', 'Bombus terrestris'], context = 'Insects'):
+#       print(record['name'], record.get('problem'), record.get('tax_order'))
+#
+#Other options (offline taxonomy, local names, cache, rate limits, http settings) are set with the same functions used
+#by the command line: open_ott_index(), open_local_names(), open_cache(), rate_limiters and configure_http()
+
+#This function searches an iterable of names (strings) or records (dictionaries with key 'name') and
+#yields records with the information found, in the same order, as soon as each one is done.
+#Records are read lazily, so the input can be larger than memory. Records with a problem have key 'problem' (see resolve_record)
+#Each unique name is searched only once, and records with the same name copy information from the first one.
+#Information found for each name is kept in resolved (name: fields, by default a ResolvedNames), which can be given to reuse names resolved before.
+#Unique names are searched in windows by a pool of threads. In batch mode (batch_size > 0), the exact-match
+#queries for each window are prefetched together before searching
+#If ncbi_column is given, records with an ncbi id in that key are found by id instead of by name (see resolve_ncbi_record),
+#and records with the same id copy information from the first one
+def resolve_names(records, gnparser = 'gnparser', context = 'All life', tax_filter = None, 
+                  threads = 1, batch_size = 0, tnrs_chunk_size = 500, gn_chunk_size = 200, ott_version = None, resolved = None,
+                  ncbi_column = None):
+    if ott_version is None:
+        ott_version = ott_taxonomy_version()
+    if resolved is None:
+        resolved = ResolvedNames()
+    if batch_size > 0:
+        window_size = batch_size
+    else:
+        window_size = threads
+    #records are not read too far ahead when there are many duplicates
+    max_pending = max(1000, 10 * window_size)
+
+    records = iter(records)
+    exhausted = False
+    pending = collections.deque() #records read and not yielded yet, in input order
+    searching = {} #first record and future for names being searched
+    
+    with ThreadPoolExecutor(max_workers = threads) as executor:
+        while True:
+            #keep at least one window of unique names being searched ahead of the record being yielded
+            while not exhausted and len(searching) <= window_size and len(pending) < max_pending:
+                window = []
+                while len(window) < window_size and len(pending) < max_pending:
+                    try:
+                        record = next(records)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if isinstance(record, str):
+                        record = {'name':record}
+                    pending.append(record)
+                    key = record_key(record, ncbi_column)
+                    if key not in resolved and key not in searching:
+                        searching[key] = (record, None, None)
+                        window.append(record)
+                        
+                if batch_size > 0:
+                    window_names = [record['name'].capitalize() for record in window 
+                                    if isinstance(record['name'], str) and record_ncbi_id(record, ncbi_column) is None]
+                    prefetch_names(list(dict.fromkeys(window_names)), gnparser, context = context, taxfilter = tax_filter, 
+                                   chunk_size = tnrs_chunk_size, gn_chunk_size = gn_chunk_size)
+                #scores are computed for the whole window when the first of its records is yielded
+                window_futures = []
+                for record in window:
+                    ncbi_id = record_ncbi_id(record, ncbi_column)
+                    if ncbi_id is None:
+                        future = executor.submit(resolve_record, record, gnparser, 
+                                                 context = context, 
+                                                 taxfilter = tax_filter, 
+                                                 ott_version = ott_version, 
+                                                 score = False)
+                    else:
+                        future = executor.submit(resolve_ncbi_record, record, ncbi_id, gnparser, 
+                                                 context = context, 
+                                                 taxfilter = tax_filter, 
+                                                 ott_version = ott_version)
+                    window_futures.append((record, future))
+                    searching[record_key(record, ncbi_column)] = (record, future, window_futures)
+            
+            if not pending:
+                break
+            record = pending.popleft()
+            key = record_key(record, ncbi_column)
+            
+            #the first record with a name is searched, and the following ones copy its information
+            if key in searching and searching[key][0] is record:
+                record, future, window_futures = searching.pop(key)
+                if window_futures:
+                    for window_record, window_future in window_futures:
+                        window_future.result()
+                    score_records([window_record for window_record, window_future in window_futures])
+                    window_futures.clear()
+                problem = future.result()
+                resolved[key] = resolution_fields(record)
+                metrics.count('records', problem or 'matched')
+            else:
+                record.update(resolved[key])
+                #records with the same ncbi id can have different names
+                if record_ncbi_id(record, ncbi_column) is not None and 'tax_matched' in record:
+                    record['tax_score'] = fuzzy_score(score_query(record), record['tax_matched'])
+                metrics.count('records', 'duplicate')
+            yield record
+
+#############################################
+#Server mode (--serve): a local HTTP service that keeps caches of names, lineages and GNparser results warm between requests
+#POST /resolve with a json object {"names": [...]} or {"records": [{"name": ..., ...}, ...]}, and optionally 
+#"context" and "tax_filter" (by default, those given in the command line)
+#The response is a json object with lists "matched" and "unmatched", with the same columns as the output tables
+#and "index" for the position of each record in the request
+#GET /health returns the version of Open Tree Taxonomy, and GET /metrics the metrics of the server (see Metrics)
+
+#returns a record as a dictionary with the columns of the output tables, with missing values as None
+def output_row(index, record, columns):
+    row = {'index':index}
+    for col in columns:
+        value = record.get(col)
+        if isinstance(value, float) and value != value:
+            value = None
+        row[output_column(col)] = value
+    return row
+
+class ResolveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #headers and body are written separately, so without this each response waits for a delayed ack from the client
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        sys.stderr.write(time.ctime() + ': ' + self.address_string() + ' ' + (format % args) + '\n')
+
+    def send_json(self, status, data):
+        body = json.dumps(data, default = str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status':'ok', 'ott_version':self.server.settings['ott_version']})
+        elif self.path == '/metrics':
+            self.send_json(200, metrics.summary())
+        else:
+            self.send_json(404, {'message':'Unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/resolve':
+            return self.send_json(404, {'message':'Unknown path ' + self.path})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(request, dict):
+                raise ValueError('the request must be a json object')
+            if 'records' in request:
+                if not isinstance(request['records'], list) or any(not isinstance(record, dict) for record in request['records']):
+                    raise ValueError('records must be a list of objects')
+                records = [dict(record) for record in request['records']]
+            else:
+                if not isinstance(request['names'], list):
+                    raise ValueError('names must be a list of strings')
+                records = [{'name':name} for name in request['names']]
+            if any('name' not in record for record in records):
+                raise ValueError('every record must have a name')
+            if any(not isinstance(record['name'], str) for record in records):
+                raise ValueError('every name must be a string')
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            return self.send_json(400, {'message':'Invalid request: ' + str(err)})
+        
+        settings = dict(self.server.settings)
+        settings['context'] = request.get('context', settings['context'])
+        settings['tax_filter'] = request.get('tax_filter', settings['tax_filter'])
+        other_cols = list(dict.fromkeys(col for record in records for col in record if col != 'name'))
+        matched_cols = matched_columns(other_cols)
+        unmatched_cols = unmatched_columns(other_cols)
+        
+        response = {'ott_version':settings['ott_version'], 'matched':[], 'unmatched':[]}
+        try:
+            for index, record in enumerate(resolve_names(records, **settings)):
+                if record.get('problem'):
+                    response['unmatched'].append(output_row(index, record, unmatched_cols))
+                else:
+                    response['matched'].append(output_row(index, record, matched_cols))
+        except Exception as err:
+            self.log_message('Error while resolving names: %s', repr(err))
+            return self.send_json(500, {'message':'Error while resolving names: ' + str(err)})
+        self.send_json(200, response)
+
+#parses the address given to --serve as [HOST:]PORT
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    try:
+        return host or '127.0.0.1', int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError('address must be given as [HOST:]PORT')
+
+#runs the server until interrupted. Other arguments are passed to resolve_names() for each request
+def serve(address, **settings):
+    server = ThreadingHTTPServer(address, ResolveHandler)
+    server.daemon_threads = True
+    server.settings = settings
+    sys.stderr.write('Serving on http://' + address[0] + ':' + str(server.server_address[1]) + '\n')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+#messages shown after processing each record
+status_messages = {None:'Record OK          ',
+                   'no_name':'Taxonomy Error: no_name',
+                   'no_taxonomy':'Taxonomy Error: no_taxonomy',
+                   'no_species':'Taxonomy Error: no_species'}
+
+#read input and run program
+# for each record in the input file, it will try to find a name using resolve_names()
+def main(arguments = None):
+    global otl_api, gn_api
     parser = argparse.ArgumentParser()
-    parser.add_argument('input', help = 'Path to input file, see docs for options')
+    parser.add_argument('input', nargs = '?', help = 'Path to input file, see docs for options')
     #parser.add_argument('output', help = 'Path to problem file')
     parser.add_argument('-o','--output', help = 'Prefix to add to output files', default = 'output')
+    parser.add_argument('--output-format', choices = ['csv', 'parquet'], default = 'csv', help = '''Format of output: two csv tables for matched and unmatched names (default), 
+                                                    or a single parquet file with a status column (requires pyarrow)''')
     parser.add_argument('-p', '--gnparser', help = 'Path to GNparser (by default search in PATH)')
     parser.add_argument('-c','--context', help = 'Taxonomic context (see Open Tree Taxonomy API for options)', default = 'All life')
     parser.add_argument('-f','--tax-filter', help = '''Comma-separated list of names of higher taxa in which queries must be included. 
                                                     Used to filter results from services other than Open Tree Taxonomy.
                                                     A result matching any taxon in the list will be kept.''')
+    parser.add_argument('-b','--batch-size', type = int, default = 0, help = '''Number of records for which exact-match queries to Open Tree Taxonomy are collected and sent together.
+                                                    By default, each name is sent in a separate request.''')
+    parser.add_argument('--tnrs-chunk-size', type = int, default = 500, help = 'Maximum number of names sent to Open Tree Taxonomy in a single batch request')
+    parser.add_argument('--gn-chunk-size', type = int, default = 200, help = 'Maximum number of names sent to Global Names in a single batch request (default: 200)')
+    parser.add_argument('--offline-ott', help = '''Path to a folder with a release of Open Tree Taxonomy (taxonomy.tsv and synonyms.tsv). 
+                                                    If given, Open Tree Taxonomy is searched locally instead of using the API''')
+    parser.add_argument('--local-names', help = '''Path to a checklist of names to use for fuzzy matching instead of Global Names, 
+                                                    or OTT to use all names within the context in the local Open Tree Taxonomy given by --offline-ott''')
+    parser.add_argument('--ncbi-column', help = '''Name of a column in the input with NCBI taxonomy ids. Records with an id are found by id in Open Tree Taxonomy
+                                                    instead of by name (without connecting to any service if using --offline-ott)''')
+    parser.add_argument('-t','--threads', type = int, default = 1, help = 'Number of records searched at the same time (default: 1)')
+    parser.add_argument('--rate-limit', type = parse_rate_limit, action = 'append', default = [], help = '''Limits for a remote service, as SERVICE=CONCURRENCY,REQUESTS_PER_SECOND.
+                                                    SERVICE is one of otl_tnrs, otl_taxonomy or gn_resolver. Either limit can be left empty.
+                                                    Can be used multiple times.''')
+    parser.add_argument('--otl-api', default = otl_api, help = 'Base address of the Open Tree of Life API (default: ' + otl_api + ')')
+    parser.add_argument('--gn-api', default = gn_api, help = 'Base address of the Global Names resolver (default: ' + gn_api + ')')
+    parser.add_argument('--timeout', type = float, default = 120, help = 'Seconds to wait for a response from a remote service before trying again (default: 120)')
+    parser.add_argument('--max-backoff', type = float, default = 600, help = 'Maximum number of seconds to wait before trying again after an error from a remote service (default: 600)')
+    parser.add_argument('--chunk-size', type = int, default = 10000, help = 'Number of input records read at a time (default: 10000)')
+    parser.add_argument('--serve', type = parse_address, metavar = '[HOST:]PORT', help = '''Instead of reading an input file, run a local HTTP service that searches names sent in json requests.
+                                                    Caches are kept between requests''')
+    parser.add_argument('--previous', metavar = 'PREFIX', help = '''Prefix of the output of a previous run. Names found there with the same context, filter and 
+                                                    version of Open Tree Taxonomy are copied instead of searched again''')
+    parser.add_argument('--shard', type = parse_shard, metavar = 'K/N', help = '''Search only records in shard K of N, so that shards can be run as independent workers. 
+                                                    Output files are named with the prefix followed by .shardK-of-N''')
+    parser.add_argument('--merge', type = int, metavar = 'N', help = 'Merge the output of N shards with the prefix given by --output, instead of searching names')
+    parser.add_argument('--ott-version', help = 'Stop if the version of Open Tree Taxonomy is not this one (for example, to make sure all shards use the same version)')
+    parser.add_argument('--resume', action = 'store_true', help = '''Resume an interrupted run with the same input and output prefix. 
+                                                    Records already processed are read from the checkpoint file and not searched again''')
+    parser.add_argument('--metrics', help = 'Path to a json file to save timings of each stage, number of requests, retries and cache hits at the end of the run')
+    parser.add_argument('--metrics-prometheus', help = 'Path to a Prometheus textfile updated with the same metrics during the run')
+    parser.add_argument('--metrics-interval', type = float, default = 15, help = 'Seconds between updates of the Prometheus textfile (default: 15)')
+    parser.add_argument('--trace', help = '''Path to a json file to save spans for each stage and remote request of each record, in the Chrome trace event format.
+                                                    A summary of the slowest records and resolution paths is shown at the end of the run''')
+    parser.add_argument('--cache-dir', help = 'Folder to keep a persistent cache of results from remote services between runs. By default, nothing is cached')
+    parser.add_argument('--cache-ttl', type = float, default = 30, help = 'Number of days after which cached results are searched again (default: 30)')
+    parser.add_argument('--cache-max-entries', type = int, default = 1000000, help = 'Maximum number of results kept in the cache, oldest are removed first (default: 1000000)')
     
-    args = parser.parse_args()
+    args = parser.parse_args(arguments)
+    if not args.input and not args.serve and not args.merge:
+        parser.error('an input file is required, unless using --serve or --merge')
+    if args.merge:
+        merge_shards(args.output, args.merge)
+        return
     if not args.gnparser:
         gnpath = 'gnparser'    
     else:
         gnpath = args.gnparser
-    #args = parser.parse_args(['-o','egg_database.txt']) #this is here for testing
+    for service, concurrency, rate in args.rate_limit:
+        rate_limiters[service].set_limits(concurrency, rate)
+    otl_api = args.otl_api.rstrip('/')
+    gn_api = args.gn_api.rstrip('/')
+    configure_http(timeout = args.timeout, max_backoff = args.max_backoff, pool_size = args.threads)
+    if args.metrics_prometheus:
+        metrics.export_prometheus(args.metrics_prometheus, interval = args.metrics_interval)
+    if args.trace:
+        start_trace()
 
 
-    #first, generate name of outfile
-    #outbase = 'corrected_' + os.path.basename(args.input) #12-aug-16 we changed the folder structure. Keeping code here for now in case needed
-    #outpath = os.path.join(os.path.dirname(args.input), outbase)
-    outpath = '.matched.txt'
-    problems_path = '.unmatched.txt'
+    #record version of ott taxonomy used here
+    if args.offline_ott:
+        open_ott_index(args.offline_ott)
+    ott_version = ott_taxonomy_version()
+    if args.ott_version and ott_version != args.ott_version:
+        raise Exception('Open Tree Taxonomy version is ' + ott_version + ', but ' + args.ott_version + ' was required with --ott-version.')
+    if args.local_names:
+        open_local_names(args.local_names, context = args.context)
+    
+    #cached results are only valid for the same version of ott taxonomy
+    if args.cache_dir:
+        open_cache(args.cache_dir, ott_version, ttl = args.cache_ttl * 86400, max_entries = args.cache_max_entries)
+
+    if args.serve:
+        serve(args.serve, 
+              gnparser = gnpath, 
+              context = args.context, 
+              tax_filter = args.tax_filter, 
+              threads = args.threads, 
+              batch_size = args.batch_size, 
+              tnrs_chunk_size = args.tnrs_chunk_size, 
+              gn_chunk_size = args.gn_chunk_size, 
+              ott_version = ott_version, 
+              ncbi_column = args.ncbi_column)
+        if args.trace:
+            tracer.write(args.trace)
+        if resolution_cache is not None:
+            resolution_cache.close()
+        return
 
-    #read input
-    intable = pandas.read_csv(args.input)
-    other_cols = intable.columns.tolist()
+    #read input in chunks of records, so that memory does not grow with the size of the input
+    #compressed input (for example, .gz or .zst) is read according to the file extension
+    other_cols = pandas.read_csv(args.input, nrows = 0).columns.tolist()
     try:
         other_cols.remove('name')
     except ValueError:
         raise Exception('The input file must have a column named "name".')
+    if args.ncbi_column and args.ncbi_column not in other_cols:
+        raise Exception('The input file does not have a column named "' + args.ncbi_column + '", given by --ncbi-column.')
     
-    records = intable.to_dict('records')
-    #print records
+    #position in the input of each record read, in the same order as records are searched
+    #when running a shard, records in other shards are skipped
+    indices = collections.deque()
+    #all columns are read as text, so that values passed through to the output do not depend on the types
+    #guessed for each chunk (for example, 1999 in one chunk and 1999.0 in a chunk with an empty cell)
+    def read_records():
+        i = 0
+        for chunk in pandas.read_csv(args.input, chunksize = args.chunk_size, dtype = str, keep_default_na = False):
+            for record in chunk.to_dict('records'):
+                if not args.shard or name_shard(record['name'], args.shard[1]) == args.shard[0]:
+                    indices.append(i)
+                    yield record
+                i += 1
+    records = read_records()
+    
+    if args.shard:
+        prefix = shard_prefix(args.output, *args.shard)
+    else:
+        prefix = args.output
 
     #loop through records, correct names and add taxonomy. Write to file after each record
-    with open(outpath,'w') as outfile, open(problems_path, 'w') as problems:
-        #record version of ott taxonomy used here
-        ott_version = requests.post('https://api.opentreeoflife.org/v3/taxonomy/about').json()['source']
-
-        for i in range(len(records)):
-            
-            #below is not used anymore, records always rewritten
-            #try:
-            #    has_tax = any([key.find('tax_') > -1 for key in list(records[i].keys())])
-            #except KeyError:
-            #    has_tax = False
-            
-            #we will first verify if name is a duplicate from a previously searched name
-            #if it is, we will just copy taxonomic information
-            previous_matches = [j for j in range(i) if records[i]['name'] == records[j]['name']]
-            if previous_matches:
-                for k, v in records[previous_matches[0]].items():
-                    if 'tax_' in k or k in ['rank', 'csub', 'cg', 'cs']:
-                        records[i][k] = v
-                        
-                    if 'problem' in k:
-                        records[i][k] = v
-                        
-                if 'problem' in records[i].keys():
-                    print(records[i], file=problems)
-                else:
-                    print(records[i], file=outfile)
-                        
-                sys.stdout.write('Record ' + str(i + 1) + 
-                                 ' of ' + 
-                                 str(len(records)) + 
-                                 ' processed. Name previously found. Copying info from record ' + 
-                                 str(previous_matches[0] + 1) +
-                                 '.\n')
-                continue
-            
-                    
-            
-                       
-            #first, record version of open tree taxonomy used here
-            records[i]['tax_ott_version'] = ott_version
-            
-            try:
-                searchname_response =  search_name(records[i]['name'].capitalize(), gnpath, context = args.context, taxfilter = args.tax_filter)
-            except (ValueError, TypeError):
-                searchname_response = None
-            #except KeyError as err:
-            #    if 's' in err.args:
-            #        searchname_response = search_name(records[i]['g'], gnpath,context = args.context, taxfilter = args.tax_filter)
-            #    else:
-            #        raise err
-            
-            #if nothing was found, add to problems with flag no_name               
-            if not searchname_response:
-                records[i].update({'problem':'no_name'})
-                print(records[i], file=problems)
-                sys.stdout.write('Record ' + str(i + 1) + ' of ' + str(len(records)) + ' processed. Taxonomy Error: no_name\n')
-                continue
-            
-            #if something was found, parse matched name to genus and species and add information to output database
-            else:
-                records[i].update(GNparser(searchname_response['current_name'], gnpath)) #this parses name found, separating genus and species
-                records[i].update({'tax_updated_fullname':searchname_response['current_name']})
-                records[i].update({'tax_name_source':searchname_response['tax_source']})
-                records[i].update({'tax_matched':searchname_response['matched_name']})
-                records[i]['tax_matched_id_in_source'] = searchname_response['source_id']
-                if searchname_response['tax_source'] == 'OTT':
-                   if searchname_response['tax_level'] == 'species':
-                       records[i]['tax_cs_ott_id'] = searchname_response['source_id']
-                   elif searchname_response['tax_level'] == 'genus':
-                       records[i]['tax_cg_ott_id'] = searchname_response['source_id']
-                if searchname_response['sp_ncbi_id']:
-                    records[i]['tax_cs_ncbi_id'] = searchname_response['sp_ncbi_id']
-                
-                try:
-                    records[i].update({'tax_score':fuzzy_score(records[i]['name'] + ' ' + records[i]['s'], records[i]['tax_matched'])})
-                except KeyError:
-                    records[i].update({'tax_score':fuzzy_score(records[i]['name'], records[i]['tax_matched'])})
-                
-
-            #if name was found, but not in OTT, try obtaining higher taxonomy from genus name in ott first
-            #if can't be found in OTT, use the taxonomy from the name source
-            #if no taxonomy from name source, output as a problem
-            if searchname_response['tax_source'] != 'OTT':
-                ott_genus_search = otl_checkname(records[i]['cg'], context = args.context)
-                if ott_genus_search and ott_genus_search['level'] == 'genus' and ott_genus_search['higher_taxonomy']:
-                    records[i].update(ott_genus_search['higher_taxonomy'])
-                    records[i]['tax_taxonomy_source'] = 'OTT'
-                    
-                elif searchname_response['higher_taxonomy'] is None:
-                    records[i].update({'problem':'no_taxonomy'})
-                    print(records[i], file=problems)
-                    sys.stdout.write('Record ' + str(i + 1) + ' of ' + str(len(records)) + ' processed. Taxonomy Error: no_taxonomy\n')
-                    continue
-                    
-                else:
-                    records[i].update(searchname_response['higher_taxonomy'])
-                    records[i]['tax_taxonomy_source'] = searchname_response['tax_source']
+    if args.output_format == 'parquet':
+        outfile = problems = ParquetWriter(prefix + '.parquet', other_cols)
+    else:
+        outfile = TableWriter(prefix + '_matched.csv', matched_columns(other_cols))
+        problems = TableWriter(prefix + '_unmatched.csv', unmatched_columns(other_cols))
 
-            #if tax_source is OTT, just record higher taxonomy        
-            else:
-                records[i]['tax_taxonomy_source'] = 'OTT'
-                records[i].update(searchname_response['higher_taxonomy'])
-                
+    #journal of processed records, so that an interrupted run can be resumed
+    #when resuming, records in the journal are written again to the output and not searched
+    checkpoint = Checkpoint(prefix + '.checkpoint.jsonl',
+                            {'input':os.path.abspath(args.input), 
+                             'context':args.context, 
+                             'tax_filter':args.tax_filter, 
+                             'shard':list(args.shard) if args.shard else None,
+                             'ncbi_column':args.ncbi_column,
+                             'ott_version':ott_version})
+    if args.resume:
+        n_finished = checkpoint.load()
+    else:
+        n_finished = 0
+    finished = checkpoint.entries()
+    checkpoint.open(resume = args.resume)
 
-            #finally, if record had a species read from OCR but only genus found, output to problems            
-            if 's' in list(records[i].keys()) and 'cs' not in list(records[i].keys()) and not args.genus_search:
-                records[i].update({'problem':'no_species'})
-                print(records[i], file=problems)
-                sys.stdout.write('Record ' + str(i + 1) + ' of ' + str(len(records)) + ' processed. Taxonomy Error: no_species\n')
-            else:
-                print(records[i], file=outfile)
-                sys.stdout.write('Record ' + str(i + 1) + ' of ' + str(len(records)) + ' processed. Record OK          \n')
-                
-            
-            sys.stdout.flush()
-            
-    #if table input, should write table output and delete dict output        
-    sys.stderr.write('Search finished, deleting temporary files and writing table output.\n')
-    with open(outpath,'r') as outfile, open(problems_path, 'r') as problems:
-        matched = [eval(line) for line in outfile]
-        unmatched = [eval(line) for line in problems]
-
-    
-    
-    taxonomic_ranks = ['tax_' + prefyx + root for root in ['domain',
-                       'kingdom',
-                       'phylum',
-                       'class',
-                       'order',
-                       'family',
-                       'tribe'] for prefyx in ['super','','sub','infra','parv']]
-    
-    first_cols = ('name',
-                        'tax_updated_fullname',
-                        'tax_taxonomy_source',
-                        'rank',
-                        'tax_matched',
-                        'tax_score',
-                        'tax_ott_id',
-                        'tax_ncbi_id',
-                        'tax_name_source',
-                        'tax_matched_id_in_source',
-                        'cg',
-                        'tax_cg_ott_id',
-                        'tax_cg_ncbi_id',
-                        'cs',
-                        'tax_cs_ott_id',
-                        'tax_cs_ncbi_id',
-                        'csub',
-                        'tax_ott_accepted_name',
-                        'tax_ott_version',
-                        'tax_higher_source')
-    
-    
-    if matched:
-        matched_df = pandas.DataFrame(matched)
-        
-        
-        present_ranks = [tax for tax in taxonomic_ranks if tax in matched_df.columns]
-        
-        ordered_cols = list(first_cols)
-        ordered_cols.extend(present_ranks)
-        ordered_cols.extend(other_cols)
-        
-        final_cols = [col for col in matched_df.columns if col not in ordered_cols]
-        ordered_cols.extend(final_cols)
-        
-        
-        matched_df = matched_df[[ col for col in ordered_cols if col in matched_df.columns]]
-        matched_df.rename(inplace=True, columns= lambda x: x.replace('tax_',''))
-        matched_df.rename(inplace=True, columns= lambda x: x.replace('rank','rank_matched'))
-        matched_df.rename(inplace=True, columns= lambda x: x.replace('csub','updated_subspecies'))
-        matched_df.rename(inplace=True, columns= lambda x: x.replace('cg','updated_genus'))
-        matched_df.rename(inplace=True, columns= lambda x: x.replace('cs','updated_species'))
-        matched_df.to_csv(args.output + '_matched.csv')
-    
-    if unmatched:
-        
-        unmatched_df = pandas.DataFrame(unmatched)
-        
-        ordered_cols = list(first_cols)
-        ordered_cols.extend(other_cols)
-        final_cols = [col for col in unmatched_df.columns if col not in ordered_cols]
-        ordered_cols.extend(final_cols)
-        
-        unmatched_df = unmatched_df[[ col for col in ordered_cols if col in unmatched_df.columns]]
-        
-        unmatched_df.rename(inplace=True, columns = lambda x: x.replace('tax_',''))
-        unmatched_df.rename(inplace=True, columns= lambda x: x.replace('rank','rank_matched'))
-        unmatched_df.rename(inplace=True, columns = lambda x: x.replace('csub','updated_subspecies'))
-        unmatched_df.rename(inplace=True, columns = lambda x: x.replace('cg','updated_genus'))
-        unmatched_df.rename(inplace=True, columns = lambda x: x.replace('cs','updated_species'))
-        unmatched_df.to_csv(args.output + '_unmatched.csv')
+    #index of the first record with each name (or ncbi id, see record_key), and information found for it
+    #each unique name is searched only once, and duplicates copy information from the first record
+    first_records = {}
     
+    #names found in a previous run are copied instead of searched
+    #they are the first names in the store of resolved names
+    if args.previous:
+        resolved = load_previous(args.previous, args.context, args.tax_filter, ott_version, ncbi_column = args.ncbi_column)
+    else:
+        resolved = ResolvedNames()
+    n_previous = len(resolved)
+    
+    #records processed before the run was interrupted
+    for n in range(n_finished):
+        next(records)
+        i = indices.popleft()
+        index, problem, record = next(finished)
+        if problem:
+            problems.write(i, record)
+        else:
+            outfile.write(i, record)
+        key = record_key(record, args.ncbi_column)
+        if key not in first_records:
+            first_records[key] = i
+            resolved[key] = resolution_fields(record)
+        metrics.count('records', 'restored')
+        sys.stdout.write('Record ' + str(i + 1) + ' restored from checkpoint.\n')
     
-    os.remove(outpath)
-    os.remove(problems_path)
+    #results are written in the same order as the input, as soon as each record is done
+    for record in resolve_names(records, gnpath, 
+                                context = args.context, 
+                                tax_filter = args.tax_filter, 
+                                threads = args.threads, 
+                                batch_size = args.batch_size, 
+                                tnrs_chunk_size = args.tnrs_chunk_size, 
+                                gn_chunk_size = args.gn_chunk_size, 
+                                ott_version = ott_version, 
+                                resolved = resolved, 
+                                ncbi_column = args.ncbi_column):
+        i = indices.popleft()
+        problem = record.get('problem')
+        if problem:
+            problems.write(i, record)
+        else:
+            outfile.write(i, record)
+        checkpoint.add(i, problem, record)
         
+        #below is not used anymore, records always rewritten
+        #try:
+        #    has_tax = any([key.find('tax_') > -1 for key in list(record.keys())])
+        #except KeyError:
+        #    has_tax = False
         
+        key = record_key(record, args.ncbi_column)
+        if key in first_records:
+            sys.stdout.write('Record ' + str(i + 1) + 
+                             ' processed. Name previously found. Copying info from record ' + 
+                             str(first_records[key] + 1) +
+                             '.\n')
+        elif key in resolved and resolved.index(key) < n_previous:
+            first_records[key] = i
+            sys.stdout.write('Record ' + str(i + 1) + ' processed. Name copied from previous output.\n')
+        else:
+            first_records[key] = i
+            sys.stdout.write('Record ' + str(i + 1) + ' processed. ' + status_messages[problem] + '\n')
+        sys.stdout.flush()
+        
+    outfile.close()
+    problems.close()
+    checkpoint.close()
+    sys.stderr.write('Search finished.\n')
+    if args.metrics:
+        metrics.write_json(args.metrics)
+    if args.metrics_prometheus:
+        metrics.write_prometheus(args.metrics_prometheus)
+    if args.trace:
+        tracer.write(args.trace)
+        sys.stderr.write(tracer.format_summary())
+    if resolution_cache is not None:
+        resolution_cache.close()
 
+if __name__ == "__main__":
+    main()
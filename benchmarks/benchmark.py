@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+### Offline benchmark for TaxReformer
+### Starts local stand-ins for Open Tree of Life (/v3/tnrs/match_names, /v3/taxonomy/taxon_info, /v3/taxonomy/about)
+###     and Global Names (name_resolvers.json), which replay recorded responses
+###     with optional injected latency and error rates
+### By default, responses are recorded for a synthetic taxonomy, but recordings of real responses can be given
+### TaxReformer.py is then run over synthetic input tables of different sizes with realistic duplication of names
+###     and records per second, peak memory (RSS) and requests per record are reported
+### Options not recognized here are passed on to TaxReformer.py (for example, --threads 8 --batch-size 500)
+
+import argparse, collections, csv, itertools, json, os, random, subprocess, sys, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+taxreformer_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'TaxReformer.py')
+
+#############################################
+#Synthetic taxonomy and recorded responses
+#Recordings are a json dictionary with the following keys:
+# about: response of /v3/taxonomy/about
+# match_names: result of /v3/tnrs/match_names for each name, as found in the list 'results' of the response
+# taxon_info: response of /v3/taxonomy/taxon_info with lineage for each ott_id
+# name_resolvers: item of 'data' in the response of name_resolvers.json for each name
+#A real recording can be made by saving responses from the live services in this format
+
+syllables = ['ba', 'ca', 'da', 'fe', 'ge', 'hi', 'ki', 'la', 'mo', 'ne', 'po', 'ra', 'si', 'to', 'ru', 'vi', 'xa', 'ze', 'lo', 'mi']
+
+def make_word(rng, n_syllables, ending):
+    return ''.join(rng.choice(syllables) for i in range(n_syllables)) + ending
+
+#returns a list of unique new words
+def make_words(rng, n, n_syllables, ending, used):
+    words = []
+    while len(words) < n:
+        word = make_word(rng, n_syllables, ending)
+        if word not in used:
+            used.add(word)
+            words.append(word)
+    return words
+
+def taxon_summary(taxon):
+    return {key:taxon[key] for key in ['name', 'ott_id', 'rank', 'tax_sources', 'unique_name']}
+
+def GN_result(name, classification, ranks, data_source_id, score):
+    return {'canonical_form':name,
+            'current_name_string':name,
+            'name_string':name,
+            'data_source_id':data_source_id,
+            'score':score,
+            'classification_path':'|'.join(classification),
+            'classification_path_ranks':'|'.join(ranks)}
+
+#returns recordings for a synthetic taxonomy of Arthropoda with about n_species species,
+#and a list of names that will be searched, including misspellings, genus names and unknown names
+def make_recordings(n_species, seed = 1):
+    rng = random.Random(seed)
+    used = set()
+    taxa = {}
+    next_id = [1000]
+
+    def add_taxon(name, rank, parent):
+        ott_id = next_id[0]
+        next_id[0] += 1
+        tax_sources = ['ncbi:' + str(ott_id * 7)] if rng.random() < 0.7 else []
+        #a few taxa have more than one ncbi id (chosen without random numbers, so that the rest of the taxonomy does not change)
+        if tax_sources and ott_id % 50 == 0:
+            tax_sources.append('ncbi:' + str(ott_id * 7 + 1))
+        tax_sources.append('gbif:' + str(ott_id * 3))
+        taxa[ott_id] = {'name':name, 'ott_id':ott_id, 'rank':rank, 'tax_sources':tax_sources,
+                        'unique_name':name, 'parent':parent}
+        return ott_id
+
+    life = add_taxon('life', 'no rank', None)
+    phylum = add_taxon('Arthropoda', 'phylum', life)
+    insecta = add_taxon('Insecta', 'class', phylum)
+    n_genera = max(1, n_species // 10)
+    n_families = max(1, n_genera // 10)
+    n_orders = max(1, n_families // 10)
+    orders = [add_taxon(name.capitalize(), 'order', insecta) for name in make_words(rng, n_orders, 3, 'ptera', used)]
+    families = [add_taxon(name.capitalize(), 'family', rng.choice(orders)) for name in make_words(rng, n_families, 2, 'idae', used)]
+    genera = [add_taxon(name.capitalize(), 'genus', rng.choice(families)) for name in make_words(rng, n_genera, 3, 'us', used)]
+    species = []
+    for genus in genera:
+        for epithet in make_words(rng, 10, 3, 'a', set()):
+            species.append(add_taxon(taxa[genus]['name'] + ' ' + epithet, 'species', genus))
+
+    def lineage(ott_id):
+        result = []
+        parent = taxa[ott_id]['parent']
+        while parent is not None:
+            result.append(taxon_summary(taxa[parent]))
+            parent = taxa[parent]['parent']
+        return result
+
+    def classification(ott_id):
+        path = [taxon_summary(taxa[ott_id])] + lineage(ott_id)
+        path = [taxon for taxon in reversed(path) if taxon['rank'] != 'no rank']
+        return [taxon['name'] for taxon in path], [taxon['rank'] for taxon in path]
+
+    recordings = {'about':{'source':'ott3.5synthetic', 'name':'ott', 'version':'3.5synthetic'},
+                  'match_names':{},
+                  'taxon_info':{},
+                  'name_resolvers':{}}
+    for ott_id, taxon in taxa.items():
+        info = taxon_summary(taxon)
+        info['lineage'] = lineage(ott_id)
+        recordings['taxon_info'][str(ott_id)] = info
+        recordings['match_names'][taxon['name']] = {'name':taxon['name'],
+                                                    'matches':[{'matched_name':taxon['name'],
+                                                                'score':1.0,
+                                                                'is_synonym':False,
+                                                                'is_approximate_match':False,
+                                                                'taxon':taxon_summary(taxon)}]}
+
+    queries = []
+    def add_query(query, ott_id, score):
+        names, ranks = classification(ott_id)
+        name = taxa[ott_id]['name']
+        recordings['name_resolvers'][query] = {'supplied_name_string':query,
+                                               'is_known_name':score == 1,
+                                               'results':[GN_result(name, names, ranks, 11, score),
+                                                          GN_result(name, names, ranks, 179, score)]}
+        queries.append(query)
+
+    for ott_id in species:
+        add_query(taxa[ott_id]['name'], ott_id, 1)
+        #misspelled names
+        if rng.random() < 0.05:
+            name = taxa[ott_id]['name']
+            position = rng.randrange(len(name) - 1, 0, -1)
+            add_query(name[:position] + rng.choice('aeiou') + name[position + 1:], ott_id, 0.9)
+    #names identified only to genus
+    for ott_id in rng.sample(genera, max(1, len(genera) // 5)):
+        add_query(taxa[ott_id]['name'] + ' sp.', ott_id, 0.75)
+    #names not found in any service
+    for name in make_words(rng, max(1, len(species) // 30), 4, 'ix', used):
+        query = name.capitalize() + ' ' + make_word(rng, 3, 'i')
+        recordings['name_resolvers'][query] = {'supplied_name_string':query, 'is_known_name':False}
+        queries.append(query)
+
+    rng.shuffle(queries)
+    return recordings, queries
+
+#############################################
+#Local stand-ins for remote services, replaying recordings
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' #keep connections alive, as the real services
+    #headers and body are written separately, so without this each keep-alive reply waits for a delayed ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data, headers = {}):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        endpoint = self.path.rstrip('/').split('/')[-1]
+        server.count(endpoint)
+
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            server.count(endpoint + '_errors')
+            return self.send_json(503, {'message':'injected error'})
+
+        recordings = server.recordings
+        if endpoint == 'match_names':
+            names = list(dict.fromkeys(payload.get('names', [])))
+            results = [recordings['match_names'][name] for name in names if name in recordings['match_names']]
+            unmatched = [name for name in names if name not in recordings['match_names']]
+            return self.send_json(200, {'results':results, 'unmatched_names':unmatched,
+                                        'context':payload.get('context_name'), 'includes_approximate_matches':False})
+        elif endpoint == 'taxon_info':
+            if 'source_id' in payload:
+                ott_id = server.source_ids.get(payload['source_id'])
+            else:
+                ott_id = payload.get('ott_id')
+            try:
+                return self.send_json(200, recordings['taxon_info'][str(ott_id)])
+            except KeyError:
+                return self.send_json(400, {'message':'Unrecognized taxon ' + str(payload)})
+        elif endpoint == 'about':
+            return self.send_json(200, recordings['about'])
+        elif endpoint == 'name_resolvers.json':
+            names = payload.get('names', '').split('|')
+            data = [recordings['name_resolvers'].get(name, {'supplied_name_string':name, 'is_known_name':False}) for name in names]
+            return self.send_json(200, {'data':data})
+        else:
+            return self.send_json(404, {'message':'Unknown endpoint ' + self.path})
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, recordings, latency = 0, error_rate = 0):
+        super().__init__(('127.0.0.1', 0), ReplayHandler)
+        self.recordings = recordings
+        self.latency = latency
+        self.error_rate = error_rate
+        self.source_ids = {}
+        for ott_id, info in recordings.get('taxon_info', {}).items():
+            for source in info.get('tax_sources', []):
+                self.source_ids[source] = ott_id
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    def reset(self):
+        with self.lock:
+            calls = dict(self.calls)
+            self.calls.clear()
+        return calls
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1])
+
+#############################################
+#Synthetic inputs and benchmark runs
+
+#Names are drawn with a Zipf-like distribution, so that a few names are very common and most are rare
+def write_input(path, queries, n_rows, zipf = 1.1, seed = 1):
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** zipf for rank in range(len(queries))))
+    names = rng.choices(queries, cum_weights = cum_weights, k = n_rows)
+    with open(path, 'w', newline = '') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(['name', 'record_id', 'locality'])
+        for i, name in enumerate(names):
+            writer.writerow([name, 'R' + str(i), rng.choice(['Brazil', 'Kenya', 'Japan', 'Peru', 'Norway'])])
+    return len(set(names))
+
+#stand-in for GNparser, used with --standin-gnparser to measure TaxReformer without the cost of GNparser
+standin_gnparser = '''#!/usr/bin/env python3
+import sys, json
+def parse(name):
+    words = name.split()
+    types = ['GENUS', 'SPECIES', 'INFRASPECIES'] if len(words) > 1 else ['UNINOMIAL']
+    words = [word for word in words if word != 'sp.']
+    return json.dumps({'parsed':True, 'words':[{'wordType':t, 'normalized':w} for t, w in zip(types, words)]})
+if '--stream' in sys.argv:
+    for line in sys.stdin:
+        print(parse(line.strip()), flush = True)
+else:
+    print(parse(sys.argv[-1]))
+'''
+
+#runs TaxReformer.py once and returns wall time, peak memory in MB, exit status and metrics reported by TaxReformer
+def run_taxreformer(input_path, prefix, gnparser, otl_server, gn_server, extra_args):
+    metrics_path = prefix + '_metrics.json'
+    command = [sys.executable, taxreformer_path, input_path,
+               '-o', prefix,
+               '-p', gnparser,
+               '--otl-api', otl_server.url + '/v3',
+               '--gn-api', gn_server.url,
+               '--metrics', metrics_path] + extra_args
+    with open(prefix + '.log', 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout = subprocess.DEVNULL, stderr = log)
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        seconds = time.perf_counter() - start
+    peak_rss = rusage.ru_maxrss / 1024 #kilobytes in linux
+    if sys.platform == 'darwin': #bytes in macOS
+        peak_rss = peak_rss / 1024
+    try:
+        with open(metrics_path) as infile:
+            metrics = json.load(infile)
+    except (OSError, ValueError):
+        metrics = None
+    return seconds, peak_rss, process.returncode, metrics
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Benchmark TaxReformer with local stand-ins for Open Tree of Life and Global Names. ' +
+                                                   'Other options are passed to TaxReformer.py')
+    parser.add_argument('--sizes', default = '1000,100000,1000000', help = 'Comma-separated numbers of rows in input tables (default: 1000,100000,1000000)')
+    parser.add_argument('--species', type = int, default = 20000, help = 'Number of species in the synthetic taxonomy (default: 20000)')
+    parser.add_argument('--zipf', type = float, default = 1.1, help = 'Exponent of the distribution of name frequencies, higher means more duplication (default: 1.1)')
+    parser.add_argument('--recordings', help = 'Path to recorded responses to replay (see make_recordings). By default, responses for a synthetic taxonomy are used')
+    parser.add_argument('--latency', type = float, default = 0, help = 'Average seconds added to each response of the stand-in services (default: 0)')
+    parser.add_argument('--error-rate', type = float, default = 0, help = 'Fraction of requests answered with an error by the stand-in services (default: 0)')
+    parser.add_argument('-p', '--gnparser', default = 'gnparser', help = 'Path to GNparser (by default search in PATH)')
+    parser.add_argument('--standin-gnparser', action = 'store_true', help = 'Use a minimal stand-in for GNparser, to exclude its cost from the benchmark')
+    parser.add_argument('--workdir', help = 'Folder for inputs, outputs and logs (by default, a temporary folder)')
+    parser.add_argument('--report', help = 'Path to save results as json')
+    parser.add_argument('--seed', type = int, default = 1, help = 'Seed for random numbers (default: 1)')
+    args, taxreformer_args = parser.parse_known_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix = 'taxreformer_benchmark_')
+    os.makedirs(workdir, exist_ok = True)
+    sys.stderr.write('Working in ' + workdir + '\n')
+
+    if args.recordings:
+        with open(args.recordings) as infile:
+            recordings = json.load(infile)
+        queries = list(recordings['name_resolvers'].keys())
+        random.Random(args.seed).shuffle(queries)
+    else:
+        recordings, queries = make_recordings(args.species, seed = args.seed)
+        with open(os.path.join(workdir, 'recordings.json'), 'w') as outfile:
+            json.dump(recordings, outfile)
+
+    gnparser = args.gnparser
+    if args.standin_gnparser:
+        gnparser = os.path.join(workdir, 'gnparser_standin.py')
+        with open(gnparser, 'w') as outfile:
+            outfile.write(standin_gnparser)
+        os.chmod(gnparser, 0o755)
+
+    otl_server = ReplayServer(recordings, latency = args.latency, error_rate = args.error_rate)
+    gn_server = ReplayServer(recordings, latency = args.latency, error_rate = args.error_rate)
+
+    results = []
+    for size in [int(x) for x in args.sizes.split(',')]:
+        input_path = os.path.join(workdir, 'input_' + str(size) + '.csv')
+        unique = write_input(input_path, queries, size, zipf = args.zipf, seed = args.seed)
+        otl_server.reset()
+        gn_server.reset()
+        sys.stderr.write('Running ' + str(size) + ' rows (' + str(unique) + ' unique names)...\n')
+
+        seconds, peak_rss, status, metrics = run_taxreformer(input_path, os.path.join(workdir, 'output_' + str(size)),
+                                                             gnparser, otl_server, gn_server, taxreformer_args)
+        calls = otl_server.reset()
+        calls.update(gn_server.reset())
+        n_calls = sum(n for endpoint, n in calls.items() if not endpoint.endswith('_errors'))
+        results.append({'rows':size,
+                        'unique_names':unique,
+                        'seconds':seconds,
+                        'records_per_second':size / seconds,
+                        'peak_rss_mb':peak_rss,
+                        'exit_status':status,
+                        'calls':calls,
+                        'calls_per_record':n_calls / size,
+                        'metrics':metrics})
+        if status != 0:
+            sys.stderr.write('TaxReformer exited with status ' + str(status) + ', see ' + os.path.join(workdir, 'output_' + str(size) + '.log') + '\n')
+
+    columns = ['rows', 'unique_names', 'seconds', 'records_per_second', 'peak_rss_mb', 'calls_per_record']
+    print('\t'.join(columns + ['calls']))
+    for result in results:
+        print('\t'.join([str(round(result[col], 3)) for col in columns] +
+                        [','.join(endpoint + '=' + str(n) for endpoint, n in sorted(result['calls'].items()))]))
+
+    if args.report:
+        with open(args.report, 'w') as outfile:
+            json.dump({'settings':vars(args), 'taxreformer_args':taxreformer_args, 'results':results}, outfile, indent = 2)